@@ -3,11 +3,26 @@
 import sys
 import re
 import math
+import itertools
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 '''
 Input: InfoContent.py [stockholmFile]
 Output: Can be configured to print the mutual information between any two pairs of sequences, as well as the entropy of any sequence
         Currently prints the 10 lowest entropy sequences, along with the top 50 mutual information pairs.
+
+Options:
+--numpy     count every joint distribution at once from a one-hot encoding of the alignment
+            (same mutual information values as the default up to rounding, requires NumPy)
+--tile=T    stream the mutual information through tiles of T x T column pairs, so memory stays
+            bounded for alignments with thousands of columns (default: 256, requires NumPy)
+--top=K     with tiles, keep and print only the top K mutual information values (default: 50)
+--save=file with tiles, also save every mutual information value to file as a float32 .npy upper
+            triangle, where pair (i,j), i < j, is at i*L - i*(i+1)/2 + j-i-1 for L columns
 '''        
 
 
@@ -245,6 +260,210 @@ def calcMutInfo(pdlist, jpmatrix):
             mimatrix[i].append(mival)
     return mimatrix
 
+# Characters of the one-hot encoding, in the order of its columns
+ALPHABET = 'ACGU-'
+
+# Encodes an alignment as an array of character codes
+# Input:
+#   seqlist - a list of sequences from the alignment
+# Output:
+#   codes - (sequences x columns) uint8 array holding the position of each
+#       character in ALPHABET, with '.' gaps coded as '-'
+
+def encodeAlignment(seqlist):
+    lookup = np.empty(256, dtype=np.uint8)
+    lookup.fill(255)
+    for code, char in enumerate(ALPHABET):
+        lookup[ord(char)] = code
+    lookup[ord('.')] = ALPHABET.index('-')
+    codes = lookup[np.frombuffer(''.join(seqlist), dtype=np.uint8)]
+    if (codes == 255).any():
+        raise TypeError("Invalid characters in alignment!")
+    return codes.reshape(len(seqlist), len(seqlist[0]))
+
+# Expands character codes into a one-hot matrix, one row per sequence and
+# five columns per alignment column
+# Input:
+#   codes - array of character codes from encodeAlignment
+# Output:
+#   onehot - (sequences x 5L) float matrix; floats keep the products on the
+#       fast BLAS path and are exact for any realistic alignment depth
+
+def oneHot(codes):
+    seqnum, columns = codes.shape
+    onehot = (codes[:, :, None] == np.arange(len(ALPHABET))).reshape(seqnum, columns * len(ALPHABET))
+    return onehot.astype(np.float64)
+
+# Counts the joint distributions of all column pairs with one matrix product
+# Input:
+#   codes - array of character codes from encodeAlignment
+# Output:
+#   counts - (5L x 5L) matrix where counts[5*i+a][5*j+b] is the number of
+#       sequences with ALPHABET[a] at column i and ALPHABET[b] at column j
+#       (the diagonal blocks hold the single column counts)
+
+def calcJointCounts(codes):
+    onehot = oneHot(codes)
+    return np.dot(onehot.T, onehot)
+
+# Sums the mutual information terms of a batch of column pairs
+# Input:
+#   joint - (pairs x 5 x 5) joint probability distributions
+#   pi, pj - (pairs x 5) probability distributions of the two columns
+# Output:
+#   mival - the mutual information of each pair
+
+def mutInfoSum(joint, pi, pj):
+    mival = np.zeros(len(joint))
+    for first, second in itertools.product(range(len(ALPHABET)), repeat=2):
+        pairjoint = joint[:, first, second]
+        present = (pairjoint != 0.0) & (pi[:, first] != 0.0) & (pj[:, second] != 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            logpart = pairjoint * np.log(pairjoint * 1.0 / (pi[:, first] * pj[:, second]))
+        mival = mival + np.where(present, logpart, 0.0)
+    return mival
+
+# Calculates the mutual information content with array operations over the
+# joint counts, giving the values of calcMutInfo(genPD(seqlist), calcJP(seqlist))
+# up to rounding (the terms are summed in ALPHABET order)
+# Input:
+#   seqlist - a list of sequences from the alignment
+# Output:
+#   mimatrix - matrix containing the mutual information values, with
+#       format mi(i,j) = mimatrix[i][j-i-1]
+
+def calcMutInfoNumpy(seqlist):
+    seqnum = len(seqlist)
+    codes = encodeAlignment(seqlist)
+    columns = codes.shape[1]
+    size = len(ALPHABET)
+    blocks = calcJointCounts(codes).reshape(columns, size, columns, size)
+    joint = blocks * 1.0 / seqnum
+    index = np.arange(columns)
+    pdarray = blocks[index, :, index, :].diagonal(axis1=1, axis2=2) * 1.0 / seqnum
+
+    coli, colj = np.triu_indices(columns, 1)
+    mival = mutInfoSum(joint[coli, :, colj, :], pdarray[coli], pdarray[colj])
+
+    # split the pairs back into one row per column i
+    mivals = mival.tolist()
+    mimatrix = []
+    start = 0
+    for i in range(columns):
+        stop = start + columns - i - 1
+        mimatrix.append(mivals[start:stop])
+        start = stop
+    return mimatrix
+
+# Streams the mutual information of all column pairs one tile at a time; only
+# the one-hot columns and joint counts of the current tile are in memory
+# Input:
+#   seqlist - a list of sequences from the alignment
+#   tile - number of columns on each side of a tile
+# Output:
+#   yields (coli, colj, mival) arrays for the pairs i < j of each tile, with
+#   the values of calcMutInfoNumpy
+
+def mutInfoTiles(seqlist, tile):
+    seqnum = len(seqlist)
+    codes = encodeAlignment(seqlist)
+    columns = codes.shape[1]
+    size = len(ALPHABET)
+    for istart in range(0, columns, tile):
+        istop = min(columns, istart + tile)
+        onehoti = oneHot(codes[:, istart:istop])
+        pi = onehoti.sum(axis=0).reshape(istop - istart, size) * 1.0 / seqnum
+        for jstart in range(istart, columns, tile):
+            jstop = min(columns, jstart + tile)
+            if jstart == istart:
+                onehotj, pj = onehoti, pi
+            else:
+                onehotj = oneHot(codes[:, jstart:jstop])
+                pj = onehotj.sum(axis=0).reshape(jstop - jstart, size) * 1.0 / seqnum
+            counts = np.dot(onehoti.T, onehotj).reshape(istop - istart, size, jstop - jstart, size)
+            coli, colj = np.nonzero(np.arange(istart, istop)[:, None] < np.arange(jstart, jstop))
+            joint = counts[coli, :, colj, :] * 1.0 / seqnum
+            yield coli + istart, colj + jstart, mutInfoSum(joint, pi[coli], pj[colj])
+
+# Merges a tile of mutual information values into the top K seen so far
+# Input:
+#   best - (mival, coli, colj) arrays of the current top values, or None
+#   coli, colj, mival - arrays of the new pairs
+#   k - number of values to keep
+# Output:
+#   best - the new top values, highest first (ties go to the lower columns)
+
+def topMerge(best, coli, colj, mival, k):
+    if best is not None:
+        mival = np.concatenate((best[0], mival))
+        coli = np.concatenate((best[1], coli))
+        colj = np.concatenate((best[2], colj))
+    order = np.lexsort((colj, coli, -mival))[:k]
+    return mival[order], coli[order], colj[order]
+
+# Calculates the mutual information tile by tile with bounded memory
+# Input:
+#   seqlist - a list of sequences from the alignment
+#   tile - number of columns on each side of a tile
+#   k - number of top values to keep, or None
+#   condensed - whether to keep every value in a float32 upper triangle
+# Output:
+#   toplist - list of (mival, i, j) for the top k pairs, or None
+#   mitriangle - float32 array with pair (i,j) at i*L - i*(i+1)/2 + j-i-1,
+#       or None
+
+def streamMutInfo(seqlist, tile, k=None, condensed=False):
+    columns = len(seqlist[0])
+    best = None
+    mitriangle = None
+    if condensed:
+        mitriangle = np.zeros(columns * (columns - 1) // 2, dtype=np.float32)
+    for coli, colj, mival in mutInfoTiles(seqlist, tile):
+        if condensed:
+            mitriangle[coli * columns - coli * (coli + 1) // 2 + colj - coli - 1] = mival
+        if k is not None:
+            best = topMerge(best, coli, colj, mival, k)
+    toplist = None
+    if k is not None:
+        toplist = []
+        if best is not None:
+            toplist = zip(best[0].tolist(), best[1].tolist(), best[2].tolist())
+    return toplist, mitriangle
+
+def testMutInfoNumpy():
+    import random
+    random.seed(0)
+    for trial in range(20):
+        seqnum = random.randint(1, 30)
+        columns = random.randint(1, seqnum)
+        seqlist = [''.join(random.choice('ACGU-.') for pos in range(columns)) for seq in range(seqnum)]
+        expected = calcMutInfo(genPD(seqlist), calcJP(seqlist))
+        mimatrix = calcMutInfoNumpy(seqlist)
+        for i in range(columns):
+            for j in range(len(expected[i])):
+                assert abs(mimatrix[i][j] - expected[i][j]) < 1e-12, "calcMutInfoNumpy() mismatch at column %d" % i
+    print "calcMutInfoNumpy() tests passed!"
+
+def testStreamMutInfo():
+    import random
+    random.seed(1)
+    for trial in range(20):
+        seqnum = random.randint(2, 30)
+        columns = random.randint(2, 40)
+        seqlist = [''.join(random.choice('ACGU-.') for pos in range(columns)) for seq in range(seqnum)]
+        mimatrix = calcMutInfoNumpy(seqlist)
+        expected = []
+        for i in range(columns):
+            for j in range(i+1, columns):
+                expected.append((mimatrix[i][j-i-1], i, j))
+        tile = random.randint(1, columns)
+        k = random.randint(1, len(expected))
+        toplist, mitriangle = streamMutInfo(seqlist, tile, k, True)
+        assert (mitriangle == np.array([val for val, i, j in expected], dtype=np.float32)).all(), "upper triangle test failed"
+        expected.sort(key=lambda entry: (-entry[0], entry[1], entry[2]))
+        assert toplist == expected[:k], "top K test failed"
+    print "streamMutInfo() tests passed!"
+
 # Handles sorting of entropy values from low to high and prints the lowest
 # 10 values while preserving the format of the input list
 # Input:
@@ -324,12 +543,32 @@ def MItop50(mimatrix):
         colstr = findMIPos(printlist[i], mimatrix)
         print "Col(i,j): %s %.12f" % (colstr, printlist[i])
 
+# Prints the top mutual information values kept by streamMutInfo
+# Input:
+#   toplist - list of (mival, i, j), highest first
+# Output:
+#   Prints the top values in the same format as MItop20 and MItop50
+
+def MItopList(toplist):
+    print "Top %d mutual information values:" % len(toplist)
+    for mival, coli, colj in toplist:
+        print "Col(i,j): %s %.12f" % ((coli, colj), mival)
+
 # Executes all test functions
 # This is only used for testing!
 
 def testAll():
     testGenPD()
     testCalcJP()
+    if np is not None:
+        testMutInfoNumpy()
+        testStreamMutInfo()
+
+def optionValue(argv, name, default=None):
+    for arg in argv:
+        if arg.startswith("--" + name + "="):
+            return arg.split("=", 1)[1]
+    return default
 
 # Executes the program when run from the command line
 # $ python InfoContent.py STOCKHOLMFILE    
@@ -337,16 +576,27 @@ def testAll():
 def main():
 
     # read command-line arguments of the form $ InfoContent.py STOCKHOLMFILE
-    if (len(sys.argv) == 1):
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    useNumpy = "--numpy" in sys.argv
+    tile = optionValue(sys.argv, "tile")
+    top = optionValue(sys.argv, "top")
+    savefile = optionValue(sys.argv, "save")
+    useTiles = tile is not None or top is not None or savefile is not None
+    tile = int(tile or 256)
+    top = int(top or 50)
+    if tile < 1 or top < 1:
+        raise ValueError("--tile and --top must be positive!")
+    if (len(args) == 0):
         raise IOError("Please enter an alignment file in Stockholm format")
-    elif (len(sys.argv) == 2):
+    elif (len(args) == 1):
         try:
-            alignfile = open(sys.argv[1])
+            alignfile = open(args[0])
         except IOError:
             raise IOError("Invalid file name!")
-        alignfile = open(sys.argv[1])
     else:
         raise IOError("Too many arguments!")
+    if (useNumpy or useTiles) and np is None:
+        raise ImportError("NumPy is required for --numpy, --tile, --top and --save!")
 
     print "Now reading alignment data..."
 
@@ -372,17 +622,40 @@ def main():
 	i += 1
 	entlist.append(strEntr)
 
-    print "Now calculating joint probability distributions..."
-    print "(this one's a little slow, so hang on tight!)"
+    if useTiles:
+        print "Now calculating mutual information values in tiles of %d columns..." % tile
+
+        # Keep only the top values (and the float32 triangle if it is saved)
+        toplist, mitriangle = streamMutInfo(sequences, tile, top, savefile is not None)
+        if savefile is not None:
+            np.save(savefile, mitriangle)
+
+        print "Now printing output values..."
+
+        print ""
+        entropyLow10(entlist)
+        print ""
+        MItopList(toplist[:20])
+        print ""
+        MItopList(toplist)
+        return
+    elif useNumpy:
+        print "Now calculating mutual information values..."
+
+        # Count every joint distribution at once and calculate the mutual information
+        mimatrix = calcMutInfoNumpy(sequences)
+    else:
+        print "Now calculating joint probability distributions..."
+        print "(this one's a little slow, so hang on tight!)"
 
-    # Calculate the joint probability distribution that a randomly selected row
-    # contains character x in column i and character y in column j
-    jpmatrix = calcJP(sequences)
+        # Calculate the joint probability distribution that a randomly selected row
+        # contains character x in column i and character y in column j
+        jpmatrix = calcJP(sequences)
 
-    print "Now calculating mutual information values..."
+        print "Now calculating mutual information values..."
 
-    # Calculate the mutual information
-    mimatrix = calcMutInfo(pdlist, jpmatrix)
+        # Calculate the mutual information
+        mimatrix = calcMutInfo(pdlist, jpmatrix)
 
     print "Now printing output values..."
 
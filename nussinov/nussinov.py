@@ -3,6 +3,17 @@ import sys
 import random
 import re
 import time
+import itertools
+import operator
+import collections
+import math
+import multiprocessing
+import mmap
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
 
 #timeStart = time.time();  #time check statement
 
@@ -12,16 +23,33 @@ Returns the number of maximum basepairs, assuming that there are no pseudoknots.
 
 Input format: python nussinov.py augcaugc 
 (augcaugc is an arbitrary RNA sequence)
-'''
 
-#check to see if an RNA sequence is input, assign seq and lenSeq to the sequence
-if len(sys.argv) < 2:
-	print "No sequence provided!"
-	sys.exit()
-seq = str(sys.argv[1]).upper()
-lenSeq = len(seq)
+Batch format: python nussinov.py --fasta=rnas.fa
+Folds every record of the FASTA file across a pool of worker processes and prints one
+"name<tab>basepairs" line per record, in input order.
 
+Options:
+--numpy		fill the table with NumPy, vectorizing each bifurcation (same result)
+--packed	NumPy fill over two packed upper triangles (row-major and column-major) of n(n+1)/2 cells each,
+		about 2n^2 bytes with uint16 cells, 4n^2 with uint32 above 65535 nt (same result)
+--fourrussians	Four-Russians fill: the bifurcations are read q ~ (log2 n)/2 splits at a time from a lookup table
+		over 0/1 step vectors, O(n^3 / log n) (same result)
+--parallel	wavefront NumPy fill of a single sequence: the table lives in shared memory and each long
+		diagonal is split across --processes worker processes (same result)
+--sparse	only try bifurcations at split points k where arr[i][k] > arr[i][k-1], kept in a candidate list
+		per row (same result)
+--test		check the Four-Russians, sparse, NumPy, packed and parallel engines against the reference fill on
+		random sequences
+--fasta=file	batch mode over the records of a FASTA file
+--processes=N	worker processes for --fasta or --parallel (default: one per CPU)
+--window=N	records read ahead and scheduled longest-first for --fasta (default: 1000)
+--span=L	local folding: scan the sequence (or each --fasta record) with windows of L+1 nt, allowing only
+		pairs with j - i <= L, in O(n L^2) time and O(L^2) memory; prints "name<tab>start<tab>end<tab>basepairs"
+		per window (1-based, inclusive). T is read as U and any other base never pairs.
+--step=s	with --span, print every s-th window only (default: 1)
 
+nussinov() and the other engines can also be imported and called on a sequence directly.
+'''
 
 #check of input RNA sequence is valid
 def isValid(seq):
@@ -45,18 +73,18 @@ def nussinov(seq):
 	arr = []
 	
 	#initialize the 2d matrix as a array of arrays
-	for i in xrange(lenSeq):
+	for i in xrange(len(seq)):
 		arr.append([])
-		for j in xrange(lenSeq):
+		for j in xrange(len(seq)):
 			arr[i].append([])
 			
 	#initialize entire array as zeroes rather than just diagonals to improve performance 
-	for a in range(lenSeq):
-		for i in range(lenSeq):
+	for a in range(len(seq)):
+		for i in range(len(seq)):
 			arr[a][i] = 0
 
-	for x in range (1,lenSeq): #one dimension of the dynamic programming table
-		for j in range(x,lenSeq): 
+	for x in range (1,len(seq)): #one dimension of the dynamic programming table
+		for j in range(x,len(seq)): 
 		
 			i=j-x #need to fill out table moving along diagonal
 			
@@ -73,16 +101,481 @@ def nussinov(seq):
 				
 				
 			arr[i][j]=max(temp1, temp2, temp3, temp4) #return max to arr[i][j]
-	return arr[0][lenSeq-1]
+	return arr[0][len(seq)-1]
+
+
+def nussinovSparse(seq):
+	n = len(seq)
+	arr = [[0] * (n + 1) for i in range(n + 1)]
+
+	#a split at k can only beat the split at k-1 if arr[i][k] > arr[i][k-1], i.e. k closes a base pair in every
+	#best structure of seq[i..k]; cand[i] keeps just those k, and grows in order since row i fills left to right
+	cand = [[] for i in range(n)]
+
+	for x in range(1, n):
+		for j in range(x, n):
+			i = j - x
+			row = arr[i]
+			best = max(row[j-1], arr[i+1][j], arr[i+1][j-1] + wc(seq[i] + seq[j]))
+			for k in cand[i]:
+				bifurcation = row[k] + arr[k+1][j]
+				if bifurcation > best:
+					best = bifurcation
+			row[j] = best
+			if best > row[j-1]:
+				cand[i].append(j)
+	if n == 0:
+		return 0
+	return arr[0][n-1]
+
+#bases as small integers, and the 4 x 4 table of which of them form a Watson-Crick pair
+def encodeRNA(seq):
+	codes = np.array(["ACGU".index(base) for base in seq], dtype=np.intp)
+	pairs = np.zeros((4,4), dtype=bool)
+	for pair in ["AU", "UA", "GC", "CG"]:
+		pairs["ACGU".index(pair[0])]["ACGU".index(pair[1])] = True
+	return codes, pairs
+
+#boolean matrix of which positions of seq can form a Watson-Crick pair
+def pairMatrix(seq):
+	codes, pairs = encodeRNA(seq)
+	return pairs[codes[:, None], codes[None, :]]
+
+def nussinovNumpy(seq):
+	n = len(seq)
+	pairs = pairMatrix(seq)
+
+	#arrT is the transpose of arr, so the column slice needed by each bifurcation is contiguous too
+	arr = np.zeros((n, n), dtype=np.int32)
+	arrT = np.zeros((n, n), dtype=np.int32)
+
+	for x in range(1, n):
+		i = np.arange(n - x)
+		j = i + x
+
+		#every cell on diagonal x only depends on earlier diagonals, so the neighbour terms are read a diagonal at a time
+		best = np.maximum(arr[i, j-1], arr[i+1, j])
+		best = np.maximum(best, arr[i+1, j-1] + pairs[i, j])
+
+		if x > 1:
+			for a in range(n - x):
+				b = a + x
+				bifurcation = (arr[a, a+1:b] + arrT[b, a+2:b+1]).max()
+				if bifurcation > best[a]:
+					best[a] = bifurcation
+
+		arr[i, j] = best
+		arrT[j, i] = best
+	return int(arr[0, n-1])
+
+#table shared with the wavefront workers: (arr, arrT, pairs), set before the pool forks
+sharedTable = None
+
+#diagonals with less bifurcation work than this are filled by the parent rather than the pool
+PARALLELWORK = 100000
+
+#n x n int32 array in anonymous shared memory, so forked workers write into the parent's table
+def sharedArray(n):
+	buf = mmap.mmap(-1, max(1, n * n * 4))
+	return np.frombuffer(buf, dtype=np.int32)[:n*n].reshape(n, n)
+
+#fill cells start .. stop-1 of diagonal x of the shared table
+def fillDiagonal(job):
+	x, start, stop = job
+	arr, arrT, pairs = sharedTable
+	i = np.arange(start, stop)
+	j = i + x
+
+	best = np.maximum(arr[i, j-1], arr[i+1, j])
+	best = np.maximum(best, arr[i+1, j-1] + pairs[i, j])
+	if x > 1:
+		for a in range(start, stop):
+			b = a + x
+			bifurcation = (arr[a, a+1:b] + arrT[b, a+2:b+1]).max()
+			if bifurcation > best[a-start]:
+				best[a-start] = bifurcation
+
+	arr[i, j] = best
+	arrT[j, i] = best
+
+def nussinovParallel(seq, processes=None):
+	global sharedTable
+	n = len(seq)
+	if processes is None:
+		processes = multiprocessing.cpu_count()
+	sharedTable = (sharedArray(n), sharedArray(n), pairMatrix(seq))
+	pool = multiprocessing.Pool(processes)
+
+	#every cell of a diagonal only reads earlier diagonals, so each diagonal is cut into runs of cells that the
+	#workers fill in place; pool.map returning is the barrier before the next diagonal
+	for x in range(1, n):
+		cells = n - x
+		if cells * x < PARALLELWORK or cells < 2 * processes:
+			fillDiagonal((x, 0, cells))
+			continue
+		pieces = 4 * processes
+		bounds = [cells * p // pieces for p in range(pieces + 1)]
+		pool.map(fillDiagonal, [(x, bounds[p], bounds[p+1]) for p in range(pieces)])
+
+	pool.close()
+	pool.join()
+	result = int(sharedTable[0][0, n-1])
+	sharedTable = None
+	return result
+
+#offset of cell (i, j), i <= j, in the row-major packed upper triangle of an n x n table
+def rowIndex(i, j, n):
+	return i * n - i * (i - 1) // 2 + (j - i)
+
+#offset of cell (i, j), i <= j, in the column-major packed upper triangle
+def colIndex(i, j):
+	return j * (j + 1) // 2 + i
+
+def nussinovPacked(seq):
+	n = len(seq)
+	codes, pairTable = encodeRNA(seq)
+
+	#only the upper triangle is stored, once row by row and once column by column so both bifurcation
+	#slices stay contiguous; uint16 holds any count (or sum of two counts) for sequences up to 65535 nt
+	if n <= 65535:
+		dtype = np.uint16
+	else:
+		dtype = np.uint32
+	size = n * (n + 1) // 2
+	rows = np.zeros(size, dtype=dtype)
+	cols = np.zeros(size, dtype=dtype)
+
+	for x in range(1, n):
+		i = np.arange(n - x)
+		j = i + x
+
+		best = np.maximum(rows[rowIndex(i, j-1, n)], rows[rowIndex(i+1, j, n)])
+		paired = pairTable[codes[i], codes[j]].astype(dtype)
+		if x > 1:
+			paired += rows[rowIndex(i+1, j-1, n)]
+		best = np.maximum(best, paired)
+
+		if x > 1:
+			for a in range(n - x):
+				b = a + x
+				left = rowIndex(a, a+1, n)
+				bifurcation = (rows[left:left+x-1] + cols[colIndex(a+2, b):colIndex(b, b)+1]).max()
+				if bifurcation > best[a]:
+					best[a] = bifurcation
 
+		rows[rowIndex(i, j, n)] = best
+		cols[colIndex(i, j)] = best
+	return int(rows[rowIndex(0, n-1, n)])
+
+def localFold(seq, span, step=1):
+	#only pairs with j - i <= span are allowed, which makes N[i][j] for j - i <= span the full fold of seq[i..j];
+	#the table is filled a column at a time and only the rows still within span of the current column are kept
+	n = len(seq)
+	m = span + 1
+	rows = [None] * m	#rows[i % m][d] is N[i][i+d]
+	colvals = [0] * m	#colvals[d] is N[j-d][j] for the current column j
+
+	for j in range(n):
+		rows[j % m] = [0] * m
+		colvals[0] = 0
+		for d in range(1, min(j, span) + 1):
+			i = j - d
+			row = rows[i % m]
+			best = max(row[d-1], colvals[d-1])
+			paired = wc(seq[i] + seq[j])
+			if d > 1:
+				paired += rows[(i+1) % m][d-2]
+				#N[i][k] + N[k+1][j] for k = i+1 .. j-1, read from row i and from the current column
+				bifurcation = max(map(operator.add, row[1:d], colvals[d-2::-1]))
+				if bifurcation > best:
+					best = bifurcation
+			if paired > best:
+				best = paired
+			row[d] = best
+			colvals[d] = best
+
+		#report the window ending at j once a full span is available (or the whole sequence, if it is shorter)
+		start = max(0, j - span)
+		if (j >= span and (j - span) % step == 0) or (j == n - 1 and n <= span):
+			yield start, j, colvals[j - start]
+
+#R[w][v] is the best prefix sum of v_t - w_t over t = 0..q-1, with bit t-1 of each code holding the 0/1 step t
+def russiansTable(q):
+	size = 1 << (q - 1)
+	table = []
+	for w in range(size):
+		column = []
+		for v in range(size):
+			best = total = 0
+			for t in range(q - 1):
+				total += ((v >> t) & 1) - ((w >> t) & 1)
+				if total > best:
+					best = total
+			column.append(best)
+		table.append(column)
+	return table
+
+def nussinovFourRussians(seq, q=None):
+	n = len(seq)
+	if n < 2:
+		return 0
+	if q is None:
+		#q ~ (log2 n) / 2 keeps the lookup table at O(n) entries while still saving a log factor
+		q = max(2, int(math.ceil(math.log(n, 2) / 2)))
+	table = russiansTable(q)
+
+	arr = [[0] * (n + 1) for i in range(n + 1)]
+	rowBase = {}	#rowBase[g][i] is arr[i][g*q-1], the value the steps of rowCodes[g][i] start from
+	rowCodes = {}	#rowCodes[g][i] packs the steps of arr[i][g*q-1 .. g*q+q-2]
+
+	#the bifurcation arr[i][k-1] + arr[k][j] is split into groups of q consecutive k; when column j has a whole
+	#group g, its q terms for every row above are read from the table instead of being summed one by one
+	for j in range(1, n):
+		best = [0] * j
+		for i in range(j - 1, -1, -1):
+			value = max(arr[i][j-1], arr[i+1][j], arr[i+1][j-1] + wc(seq[i] + seq[j]), best[i])
+
+			#k outside the whole groups already pushed into best[i]: the head of the group of i+2 and
+			#the unfinished group at the bottom of the column
+			head = min(j, -(-(i + 2) // q) * q - 1)
+			for k in range(i + 2, head + 1):
+				value = max(value, arr[i][k-1] + arr[k][j])
+			tail = max(head + 1, ((j + 1) // q) * q)
+			for k in range(tail, j + 1):
+				value = max(value, arr[i][k-1] + arr[k][j])
+			arr[i][j] = value
+
+			#row i was the last of its group to be filled in column j, so the group can be pushed to the rows above
+			g = i // q
+			if i == g * q and g > 0 and i + q - 1 <= j:
+				code = 0
+				for t in range(q - 1):
+					code |= (arr[i+t][j] - arr[i+t+1][j]) << t
+				column = table[code]
+				add = arr[i][j]
+				codes = rowCodes[g]
+				base = rowBase[g]
+				for r in range(i - 1):
+					candidate = base[r] + add + column[codes[r]]
+					if candidate > best[r]:
+						best[r] = candidate
+
+		#the row steps of group g span columns g*q-1 .. g*q+q-2, so they are final once column g*q+q-2 is done
+		if (j + 2) % q == 0 and j + 2 >= 2 * q:
+			g = (j + 2) // q - 1
+			start = g * q
+			base = [arr[r][start-1] for r in range(start - 1)]
+			codes = []
+			for r in range(start - 1):
+				row = arr[r]
+				code = 0
+				for t in range(q - 1):
+					code |= (row[start+t] - row[start+t-1]) << t
+				codes.append(code)
+			rowBase[g] = base
+			rowCodes[g] = codes
+	return arr[0][n-1]
+
+#check the Four-Russians engine against the reference fill on random sequences
+def testFourRussians():
+	for trial in range(200):
+		seq = ''.join(random.choice("ACGU") for x in range(random.randint(1, 80)))
+		expected = nussinov(seq)
+		assert nussinovFourRussians(seq) == expected, "Four-Russians failed on " + seq
+		for q in [2, 3, 5]:
+			assert nussinovFourRussians(seq, q) == expected, "Four-Russians q=" + str(q) + " failed on " + seq
+	print "Four-Russians tests passed"
+
+#check the sparse engine against the reference fill on random sequences
+def testSparse():
+	for trial in range(200):
+		seq = ''.join(random.choice("ACGU") for x in range(random.randint(0, 80)))
+		expected = nussinov(seq) if seq else 0
+		assert nussinovSparse(seq) == expected, "sparse failed on " + seq
+	print "Sparse tests passed"
+
+#check the NumPy fill against the reference fill on random sequences
+def testNumpy():
+	for trial in range(200):
+		seq = ''.join(random.choice("ACGU") for x in range(random.randint(1, 80)))
+		assert nussinovNumpy(seq) == nussinov(seq), "NumPy failed on " + seq
+	print "NumPy tests passed"
+
+#check the packed-triangle fill against the reference fill on random sequences
+def testPacked():
+	for trial in range(200):
+		seq = ''.join(random.choice("ACGU") for x in range(random.randint(1, 80)))
+		assert nussinovPacked(seq) == nussinov(seq), "packed failed on " + seq
+	print "Packed tests passed"
+
+#check the wavefront fill against the reference fill; the work threshold is dropped so even short
+#diagonals are split across the pool
+def testParallel():
+	global PARALLELWORK
+	saved = PARALLELWORK
+	PARALLELWORK = 0
+	try:
+		for trial in range(20):
+			seq = ''.join(random.choice("ACGU") for x in range(random.randint(1, 80)))
+			assert nussinovParallel(seq, 2) == nussinov(seq), "parallel failed on " + seq
+	finally:
+		PARALLELWORK = saved
+	print "Parallel tests passed"
+
+#engine chosen by the command line flags
+def foldEngine(argv):
+	if "--numpy" in argv or "--packed" in argv:
+		if np is None:
+			print "NumPy is required for --numpy and --packed!"
+			sys.exit()
+		if "--packed" in argv:
+			return nussinovPacked
+		return nussinovNumpy
+	if "--parallel" in argv:
+		if np is None:
+			print "NumPy is required for --parallel!"
+			sys.exit()
+		return nussinovParallel
+	if "--sparse" in argv:
+		return nussinovSparse
+	if "--fourrussians" in argv:
+		return nussinovFourRussians
+	return nussinov
+
+#value of a --name=value option, or default if it is not given
+def optionValue(argv, name, default=None):
+	for arg in argv:
+		if arg.startswith("--" + name + "="):
+			return arg.split("=", 1)[1]
+	return default
+
+def readFasta(infile):
+	name, seq = None, []
+	for line in infile:
+		if line.startswith(">"):
+			if name:
+				yield(name, ''.join(seq))
+			name, seq = line.strip(), []
+		else:
+			seq.append(line.strip())
+	if name:
+		yield (name, ''.join(seq))
+
+#fold one sequence in a worker; None marks a sequence that isn't valid RNA
+def foldSequence(engine, seq):
+	if re.search(r"[^ACGU]", seq):
+		return None
+	if len(seq) == 0:
+		return 0
+	return engine(seq)
+
+def foldBatch(records, engine, processes=None, window=1000):
+	pool = multiprocessing.Pool(processes)
+	pending = collections.deque()
+
+	#each window is queued longest sequence first so the long folds start early rather than straggle,
+	#and the next window is queued before the previous one is drained so the workers never idle between windows
+	while True:
+		chunk = list(itertools.islice(records, window))
+		if not chunk:
+			break
+		results = [None] * len(chunk)
+		for k in sorted(range(len(chunk)), key=lambda k: -len(chunk[k][1])):
+			results[k] = pool.apply_async(foldSequence, (engine, chunk[k][1].upper()))
+		pending.extend((chunk[k][0][1:].strip(), results[k]) for k in range(len(chunk)))
+
+		while len(pending) > window:
+			name, result = pending.popleft()
+			yield name, result.get()
+
+	while pending:
+		name, result = pending.popleft()
+		yield name, result.get()
+	pool.close()
+	pool.join()
+
+def main():
+	if "--test" in sys.argv:
+		testFourRussians()
+		testSparse()
+		if np is not None:
+			testNumpy()
+			testPacked()
+			testParallel()
+		return
+	engine = foldEngine(sys.argv)
+
+	fastaName = optionValue(sys.argv, "fasta")
+	span = optionValue(sys.argv, "span")
+	if span is not None:
+		span = int(span)
+		step = int(optionValue(sys.argv, "step", 1))
+		infile = None
+		if fastaName is not None:
+			try:
+				infile = open(fastaName, 'r')
+			except IOError:
+				print "Could not open FASTA file!"
+				sys.exit()
+
+			#records are read one at a time, so only the chromosome being scanned is in memory
+			records = readFasta(infile)
+		else:
+			args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+			if len(args) < 1:
+				print "No sequence provided!"
+				sys.exit()
+			records = [(">seq", args[0])]
+		for name, seq in records:
+			name = name[1:].strip()
+			for start, end, count in localFold(seq.upper().replace("T", "U"), span, step):
+				print name + "\t" + str(start+1) + "\t" + str(end+1) + "\t" + str(count)
+		if infile is not None:
+			infile.close()
+		return
+
+	processes = optionValue(sys.argv, "processes")
+	if processes is not None:
+		processes = int(processes)
+
+	if fastaName is not None:
+		if engine is nussinovParallel:
+			print "--parallel folds a single sequence; use --processes to spread --fasta records over cores!"
+			sys.exit()
+		window = int(optionValue(sys.argv, "window", 1000))
+		try:
+			infile = open(fastaName, 'r')
+		except IOError:
+			print "Could not open FASTA file!"
+			sys.exit()
+		for name, count in foldBatch(readFasta(infile), engine, processes, window):
+			if count is None:
+				print name + "\tNot valid sequence!"
+			else:
+				print name + "\t" + str(count)
+			sys.stdout.flush()
+		infile.close()
+		return
+
+	#check to see if an RNA sequence is input, assign seq to the sequence
+	args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	if len(args) < 1:
+		print "No sequence provided!"
+		sys.exit()
+	seq = str(args[0]).upper()
 
-#actually run nussinov on input	
-if isValid(seq):
-	print "\nMaximum number of basepairs is " +  str(nussinov(seq))
+	#actually run nussinov on input
+	if isValid(seq):
+		if engine is nussinovParallel:
+			count = nussinovParallel(seq, processes)
+		else:
+			count = engine(seq)
+		print "\nMaximum number of basepairs is " +  str(count)
 
 
-#time check statement
-#timeEnd = time.time()-timeStart
-#print "\n"+ str(timeEnd) + " seconds"
+	#time check statement
+	#timeEnd = time.time()-timeStart
+	#print "\n"+ str(timeEnd) + " seconds"
 
-		
\ No newline at end of file
+if __name__ == "__main__":
+	main()
@@ -4,6 +4,15 @@ import string
 import textwrap
 import random
 import re
+import os
+import array
+import itertools
+import multiprocessing
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
 
 # input from command line looks like this:
 # $ python hw6.py matrixfile sequencefile
@@ -18,8 +27,43 @@ next N lines: N x N matrix of values, all separated by a space, indicating gap p
 sequenceFile format: fasta format, contains at least 2 sequences.
 
 Returns: highest scoring alignment of the first 2 sequences, along with the alignment score.
+
+Database search: alignment.py search [matrixFile] [queryFile] [databaseFile]
+Builds (or reuses) a k-mer index of databaseFile, then reports the best ungapped local hits
+of every query ranked by score.
+--k=N			k-mer length of the index (default 3)
+--index=file	index location (default databaseFile.kmi), rebuilt when databaseFile changes
+--hits=N		number of ranked hits printed per query (default 20)
+--xdrop=N		stop extending a seed once the score falls N below the best seen (default 20)
+--window=N		only extend a seed after a second hit on the same diagonal within N residues,
+				0 extends every seed (default 40)
+
+Options:
+--dump			print the full score matrix before the alignment
+--score			print only the alignment score, keeping two rows of the matrix
+--hirschberg	linear memory divide and conquer alignment (same alignment and score)
+--numpy			fill the score matrix a row at a time with NumPy (same alignment and score)
+--band[=k]		banded alignment starting from band width k (default 8), doubled until the band provably holds the optimum
+--myers			bit-parallel edit distance engine, used automatically when the matrix has one match score,
+				one mismatch score and gap = match/2 - (match - mismatch), e.g. 0/-1/-1 or 2/-1/-2
+--pairs[=outFile]	align records 1 and 2, 3 and 4, ... in vectorized batches, writing one score per pair
+				(default stdout); --lanes=N pairs per batch (default 256), --traceback also prints alignments
+--test			check every alignment engine against the full score matrix on random sequences
+--all[=outFile]	score every pair of sequences and write a distance matrix for UPGMA.py (default stdout)
+				--processes=N worker processes (default all cores), --chunk=N pairs per task (default 1000)
 '''
 
+#traceback directions, one byte per cell. Ties prefer left, then up, then diagonal
+LEFT	= 1
+UP		= 2
+DIAG	= 3
+
+#blocks with fewer cells than this are aligned directly by the Hirschberg recursion
+BLOCKCELLS = 4096
+
+#first word of a saved k-mer index file
+INDEXMAGIC = "KMERINDEX1"
+
 
 def readFasta(infile):
 	name, seq = None, []
@@ -63,103 +107,558 @@ def prepMatrix(firststr,secondstr,scorelist,gap):
 	for x in range(len2):
 		array[x+2][1] = gap * (x+1)
 
+	#one direction byte per cell, recorded during the fill so the traceback never re-tests scores
+	directions = [bytearray([LEFT]) * (len1+1)]
+
 	for i in range(2, len2+2):
+		dirs = bytearray(len1+1)
+		dirs[0] = UP
 		for j in range(2, len1+2):
 			temp1 = array[i-1][j-1] + scorelist[firststr[j-2] + secondstr[i-2]]
 			temp2 = array[i][j-1] + gap
 			temp3 = array[i-1][j] + gap
 			array[i][j] = max(temp1, temp2, temp3)
+			if array[i][j] == temp2:
+				dirs[j-1] = LEFT
+			elif array[i][j] == temp3:
+				dirs[j-1] = UP
+			else:
+				dirs[j-1] = DIAG
+		directions.append(dirs)
 			
-	return array
+	return array, directions
+
+def printAlignment(name1,firststr,name2,secondstr,directions,score,array=None):
 
-def printAlignment(name1,firststr,name2,secondstr,array,gap):
+	#the score matrix is only printed when it is passed in
+	if array is not None:
+		rows = ['\n\n']
+		for row in array:
+			rows.append("|" + "|".join([str(cell) for cell in row]) + "|\n")
+		rows.append('\n')
+		sys.stdout.write(''.join(rows))
+
+	align1, align2 = traceDirections(firststr,secondstr,directions)
+	printAligned(name1,align1,name2,align2,score)
+
+def printAligned(name1,align1,name2,align2,score):
+
+	output = [name1 + " aligned to " + name2]
+	output.append('\n'.join(textwrap.wrap(align1, 80)))
+	output.append('\n'.join(textwrap.wrap(align2, 80)))
+	output.append('\n')
+	output.append("Alignment score: " + str(score))
+	sys.stdout.write('\n'.join(output) + '\n')
+
+def alignBlock(firststr,secondstr,scorelist,gap):
 
 	len1 = len(firststr)
 	len2 = len(secondstr)
 
-	arrString = ""	
-	for x in range(len2+2):
-		for y in range(len1+2):
-			arrString += ("|" + str(array[x][y]))
-		arrString += ("|" + '\n')
+	#full score table is never kept, only the previous row and a direction byte per cell
+	prev = [gap * x for x in range(len1+1)]
+	directions = [bytearray([LEFT]) * (len1+1)]
 
-	a = len2+1
-	b = len1+1
-	align1 = ""
-	align2 = ""
+	for i in range(1, len2+1):
+		char2 = secondstr[i-1]
+		row = [gap * i]
+		dirs = bytearray(len1+1)
+		dirs[0] = UP
+		for j in range(1, len1+1):
+			left = row[j-1] + gap
+			up = prev[j] + gap
+			best = max(prev[j-1] + scorelist[firststr[j-1] + char2], left, up)
+			if best == left:
+				dirs[j] = LEFT
+			elif best == up:
+				dirs[j] = UP
+			else:
+				dirs[j] = DIAG
+			row.append(best)
+		directions.append(dirs)
+		prev = row
 
-	while ((a > 1) or ( b > 1)):
+	return directions, prev[len1]
 
-		currentScore = array[a][b]
+def traceDirections(firststr,secondstr,directions,starts=None):
 
-		left = array[a][b-1]
-		up = array[a-1][b]
-		diag = array[a-1][b-1]
-		#print currentScore
-		if (currentScore == left + gap):
-		#	print "1"
+	a = len(secondstr)
+	b = len(firststr)
+	align1 = []
+	align2 = []
+
+	#for banded tables, row a only holds columns from starts[a] onwards
+	while ((a > 0) or (b > 0)):
+		if starts is None:
+			move = directions[a][b]
+		else:
+			move = directions[a][b - starts[a]]
+		if move == LEFT:
 			b = b-1
-			align2 += "-"
-			align1 += (str(firststr[b-1]))
-		elif (currentScore == up + gap):
-		#	print "2"
+			align1.append(firststr[b])
+			align2.append("-")
+		elif move == UP:
+			a = a-1
+			align1.append("-")
+			align2.append(secondstr[a])
+		else:
 			a = a-1
-			align1 += "-"
-			align2 += (str(secondstr[a-1]))
+			b = b-1
+			align1.append(firststr[b])
+			align2.append(secondstr[a])
+
+	align1.reverse()
+	align2.reverse()
+	return ''.join(align1), ''.join(align2)
+
+def bandedFill(firststr,secondstr,scorelist,gap,lo,hi):
+
+	len1 = len(firststr)
+	len2 = len(secondstr)
+	NEG = float("-inf")
+
+	#only cells with lo <= j - i <= hi are filled; row i covers columns starts[i] .. starts[i] + len(row) - 1
+	prevStart = 0
+	prev = [gap * x for x in range(min(len1, hi) + 1)]
+	starts = [0]
+	directions = [bytearray([LEFT]) * len(prev)]
+
+	for i in range(1, len2+1):
+		char2 = secondstr[i-1]
+		start = max(0, i + lo)
+		stop = min(len1, i + hi)
+		prevStop = prevStart + len(prev) - 1
+		row = []
+		dirs = bytearray(stop - start + 1)
+
+		for j in range(start, stop+1):
+			if j == 0:
+				row.append(gap * i)
+				dirs[0] = UP
+				continue
+			if j > start:
+				left = row[-1] + gap
+			else:
+				left = NEG
+			if j <= prevStop:
+				up = prev[j - prevStart] + gap
+			else:
+				up = NEG
+			best = max(prev[j - 1 - prevStart] + scorelist[firststr[j-1] + char2], left, up)
+			if best == left:
+				dirs[j - start] = LEFT
+			elif best == up:
+				dirs[j - start] = UP
+			else:
+				dirs[j - start] = DIAG
+			row.append(best)
+
+		starts.append(start)
+		directions.append(dirs)
+		prev = row
+		prevStart = start
+
+	return starts, directions, prev[-1]
+
+def bandBound(firststr,secondstr,scorelist,gap,k):
+
+	len1 = len(firststr)
+	len2 = len(secondstr)
 
+	#a path that leaves the band needs at least this many gapped residues
+	gaps = abs(len1 - len2) + 2 * (k + 1)
+	if gaps > len1 + len2:
+		return None
+
+	#an aligned pair scores at most the mean of its two residues' best possible scores,
+	#so every gapped residue costs at least half its best score minus the gap score
+	chars1 = set(firststr)
+	chars2 = set(secondstr)
+	best1 = dict((a, max([scorelist[a + b] for b in chars2])) for a in chars1)
+	best2 = dict((b, max([scorelist[a + b] for a in chars1])) for b in chars2)
+
+	bound = 0.0
+	penalties = []
+	for a in firststr:
+		bound += best1[a] * 0.5
+		penalties.append(best1[a] * 0.5 - gap)
+	for b in secondstr:
+		bound += best2[b] * 0.5
+		penalties.append(best2[b] * 0.5 - gap)
+	penalties.sort()
+
+	for x in range(len(penalties)):
+		if x < gaps or penalties[x] < 0:
+			bound -= penalties[x]
+	return bound
+
+def bandedAlign(firststr,secondstr,scorelist,gap,band=8):
+
+	diff = len(firststr) - len(secondstr)
+	k = max(1, band)
+
+	#double the band until no path outside it can score as well as the best path inside it
+	while True:
+		starts, directions, score = bandedFill(firststr,secondstr,scorelist,gap,min(0, diff) - k,max(0, diff) + k)
+		bound = bandBound(firststr,secondstr,scorelist,gap,k)
+		if bound is None or score > bound:
+			break
+		k = k * 2
+
+	align1, align2 = traceDirections(firststr,secondstr,directions,starts)
+	return align1, align2, score, k
+
+def unitCostScheme(characters,scorelist,gap):
+
+	#returns (match, mismatch) when maximising the score is the same as minimising the edit distance
+	match = scorelist[characters[0] + characters[0]]
+	mismatch = None
+	for a in characters:
+		for b in characters:
+			if a == b:
+				if scorelist[a + b] != match:
+					return None
+			elif mismatch is None:
+				mismatch = scorelist[a + b]
+			elif scorelist[a + b] != mismatch:
+				return None
+	if mismatch is None:
+		mismatch = match - 1
+	if match <= mismatch or 2 * (match - mismatch) != match - 2 * gap:
+		return None
+	return match, mismatch
+
+def myersColumns(firststr,secondstr,columns=None):
+
+	#Myers' bit-vector algorithm, one bit per character of secondstr, one step per character of firststr
+	len2 = len(secondstr)
+	if len2 == 0:
+		if columns is not None:
+			columns.extend([(0, 0)] * len(firststr))
+		return len(firststr)
+
+	peq = {}
+	for i in range(len2):
+		peq[secondstr[i]] = peq.get(secondstr[i], 0) | (1 << i)
+
+	mask = (1 << len2) - 1
+	high = 1 << (len2 - 1)
+	pv = mask
+	mv = 0
+	dist = len2
+
+	for char in firststr:
+		eq = peq.get(char, 0)
+		xv = eq | mv
+		xh = (((eq & pv) + pv) ^ pv) | eq
+		ph = mv | (~(xh | pv) & mask)
+		mh = pv & xh
+		if ph & high:
+			dist += 1
+		elif mh & high:
+			dist -= 1
+
+		#global alignment: the top row always rises by one per column
+		ph = ((ph << 1) | 1) & mask
+		mh = (mh << 1) & mask
+		pv = mh | (~(xv | ph) & mask)
+		mv = ph & xv
+		if columns is not None:
+			columns.append((pv, mv))
+
+	return dist
+
+def myersAlign(firststr,secondstr):
+
+	len1 = len(firststr)
+	len2 = len(secondstr)
+
+	#vertical +1/-1 deltas of every column, column 0 rises by one per row
+	columns = [((1 << len2) - 1, 0)]
+	dist = myersColumns(firststr,secondstr,columns)
+
+	def distance(i, j):
+		low = (1 << i) - 1
+		pv, mv = columns[j]
+		return j + bin(pv & low).count("1") - bin(mv & low).count("1")
+
+	#same tie order as the score traceback: left, up, diagonal
+	a = len2
+	b = len1
+	current = dist
+	if b > 0:
+		left = distance(a, b-1)
+	align1 = []
+	align2 = []
+
+	while ((a > 0) or (b > 0)):
+		if a > 0:
+			pv, mv = columns[b]
+			up = current - ((pv >> (a-1)) & 1) + ((mv >> (a-1)) & 1)
+		if b > 0 and (a == 0 or current == left + 1):
+			b = b-1
+			align1.append(firststr[b])
+			align2.append("-")
+			current = left
+			if b > 0:
+				left = distance(a, b-1)
+		elif b == 0 or current == up + 1:
+			a = a-1
+			align1.append("-")
+			align2.append(secondstr[a])
+			current = up
+			if b > 0:
+				pv, mv = columns[b-1]
+				left = left - ((pv >> a) & 1) + ((mv >> a) & 1)
 		else:
-		#	print "3"
 			a = a-1
 			b = b-1
-			if ((b > 0) & (a > 0)):
-				align2 += (str(secondstr[a-1]))
-				align1 += (str(firststr[b-1]))
+			align1.append(firststr[b])
+			align2.append(secondstr[a])
+			pv, mv = columns[b]
+			current = left - ((pv >> a) & 1) + ((mv >> a) & 1)
+			if b > 0:
+				left = distance(a, b-1)
 
-	align1 = align1[::-1]
-	align1 = textwrap.wrap(align1, 80)
-	align1 = '\n'.join(align1)
+	align1.reverse()
+	align2.reverse()
+	return ''.join(align1), ''.join(align2), dist
 
-	align2 = align2[::-1]
-	align2 = textwrap.wrap(align2, 80)
-	align2 = '\n'.join(align2)
-	
-	print '\n'
-	print arrString
+def myersScore(scheme,gap,len1,len2,dist):
 
-	print name1 + " aligned to " + name2
-	print align1
-	print align2
-	print '\n'
+	#score = match * (aligned residues) / 2 - (match - mismatch) * edit distance
+	match, mismatch = scheme
+	return (match - mismatch + gap) * (len1 + len2) - (match - mismatch) * dist
 
+def hirschbergSplit(firststr,secondstr,scorelist,gap,mid):
 
-def main():
+	len1 = len(firststr)
+	len2 = len(secondstr)
 
-	# Read from command line and check for valid input files
-	if len(sys.argv) < 3:
-		print "Not enough arguments! Need input file and output file."
-		sys.exit()
-		
-	input1File = sys.argv[1]
-	input2File = sys.argv[2]
-		
-	try:
-		infile = open(input1File)
-	except IOError:
-		print "The input file does not exist!"
-		sys.exit()
+	#forward scores down to row mid
+	prev = [gap * x for x in range(len1+1)]
+	for i in range(1, mid+1):
+		char2 = secondstr[i-1]
+		row = [gap * i]
+		for j in range(1, len1+1):
+			row.append(max(prev[j-1] + scorelist[firststr[j-1] + char2], row[j-1] + gap, prev[j] + gap))
+		prev = row
 
-	try:
-		infile = open(input2File)
-	except IOError:
-		print "The output file does not exist!"
-		sys.exit()
+	#below row mid, also carry the column at which the traceback from each cell would enter row mid
+	prevEntry = range(len1+1)
+	for i in range(mid+1, len2+1):
+		char2 = secondstr[i-1]
+		row = [gap * i]
+		entry = [prevEntry[0]]
+		for j in range(1, len1+1):
+			left = row[j-1] + gap
+			up = prev[j] + gap
+			best = max(prev[j-1] + scorelist[firststr[j-1] + char2], left, up)
+			if best == left:
+				entry.append(entry[j-1])
+			elif best == up:
+				entry.append(prevEntry[j])
+			else:
+				entry.append(prevEntry[j-1])
+			row.append(best)
+		prev = row
+		prevEntry = entry
 
-	# Parse the matrix file
-	matrixFile = open(input1File)
+	return prevEntry[len1], prev[len1]
+
+def hirschbergBlock(firststr,secondstr,scorelist,gap,align1,align2):
+
+	len1 = len(firststr)
+	len2 = len(secondstr)
+
+	if len2 < 2 or len1 < 2 or len1 * len2 <= BLOCKCELLS:
+		directions, score = alignBlock(firststr,secondstr,scorelist,gap)
+		block1, block2 = traceDirections(firststr,secondstr,directions)
+		align1.append(block1)
+		align2.append(block2)
+		return score
+
+	#the traceback path enters the middle row at column split, so the two halves can be aligned separately
+	mid = len2 // 2
+	split, score = hirschbergSplit(firststr,secondstr,scorelist,gap,mid)
+
+	hirschbergBlock(firststr[:split],secondstr[:mid],scorelist,gap,align1,align2)
+	hirschbergBlock(firststr[split:],secondstr[mid:],scorelist,gap,align1,align2)
+	return score
+
+def hirschberg(firststr,secondstr,scorelist,gap):
+
+	align1 = []
+	align2 = []
+	score = hirschbergBlock(firststr,secondstr,scorelist,gap,align1,align2)
+	return ''.join(align1), ''.join(align2), score
+
+
+def encodeMatrix(characters,scorelist):
+
+	#residues become small integers, the substitution scores a 2-D array indexed by them
+	num = len(characters)
+	lookup = np.zeros(256, dtype=np.uint8)
+	matrix = np.zeros((num,num), dtype=np.int64)
+	for i in range(num):
+		lookup[ord(characters[i])] = i
+		for j in range(num):
+			matrix[i][j] = scorelist[characters[i] + characters[j]]
+	return lookup, matrix
+
+def encodeSequence(seq,lookup):
+
+	return lookup[np.frombuffer(seq, dtype=np.uint8)]
+
+def fillNumpy(codes1,codes2,matrix,gap,directions=None):
+
+	len1 = len(codes1)
+	len2 = len(codes2)
+
+	#gap scores along the top row, also used to turn the left-neighbour dependency into a prefix max
+	offsets = gap * np.arange(len1+1, dtype=np.int64)
+	prev = offsets.copy()
+	if directions is not None:
+		directions[0] = LEFT
+
+	for i in range(1, len2+1):
+		row = np.empty(len1+1, dtype=np.int64)
+		row[0] = gap * i
+		up = prev[1:] + gap
+		np.maximum(prev[:-1] + matrix[codes1, codes2[i-1]], up, out=row[1:])
+
+		#row[j] = max over k <= j of (row[k] + gap*(j-k))
+		row -= offsets
+		np.maximum.accumulate(row, out=row)
+		row += offsets
+
+		if directions is not None:
+			dirs = directions[i]
+			dirs[0] = UP
+			dirs[1:] = DIAG
+			dirs[1:][row[1:] == up] = UP
+			dirs[1:][row[1:] == row[:-1] + gap] = LEFT
+		prev = row
+
+	return prev
+
+def padCodes(seqs,lookup):
+
+	#encode a list of sequences into one zero-padded 2-D array, one row per sequence
+	lengths = np.array([len(seq) for seq in seqs], dtype=np.intp)
+	width = lengths.max() if len(seqs) else 0
+	codes = np.zeros((len(seqs), width), dtype=np.intp)
+	flat = lookup[np.frombuffer(''.join(seqs), dtype=np.uint8)]
+	starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+	codes[np.repeat(np.arange(len(seqs)), lengths), np.arange(len(flat)) - starts] = flat
+	return codes, lengths
+
+def batchAlign(firsts,seconds,lookup,matrix,gap,traceback=False):
+
+	#one lane per pair: lane k aligns firsts[k] against seconds[k], all lanes advance a row at a time
+	num = len(firsts)
+	codes1, len1 = padCodes(firsts,lookup)
+	codes2, len2 = padCodes(seconds,lookup)
+	width = codes1.shape[1]
+	depth = codes2.shape[1]
+
+	#rows are kept as score - gap * column, which turns the left-neighbour dependency into a plain prefix max;
+	#profile row (k, c) holds the substitution scores (minus the gap shift) of residue c against lane k's first sequence
+	size = matrix.shape[0]
+	profile = np.ascontiguousarray((matrix.T.astype(np.int32) - gap)[:, codes1].transpose(1, 0, 2)).reshape(num * size, width)
+	base = np.arange(num) * size
+	offsets = gap * np.arange(width+1, dtype=np.int32)
+	prev = np.zeros((num, width+1), dtype=np.int32)
+	row = np.empty_like(prev)
+	up = np.empty((num, width), dtype=np.int32)
+
+	#padding only ever sits below or right of a lane's own last cell, so it never changes that lane's score
+	scores = offsets[len1]
+	byDepth = np.argsort(len2, kind="mergesort")
+	ends = np.searchsorted(len2[byDepth], np.arange(depth+2))
+
+	directions = None
+	if traceback:
+		directions = np.empty((num, depth+1, width+1), dtype=np.uint8)
+		directions[:, 0] = LEFT
+
+	for i in range(1, depth+1):
+		diag = profile.take(base + codes2[:, i-1], axis=0)
+		diag += prev[:, :-1]
+		np.add(prev[:, 1:], gap, out=up)
+		np.maximum(diag, up, out=row[:, 1:])
+		row[:, 0] = gap * i
+		np.maximum.accumulate(row, axis=1, out=row)
+
+		if traceback:
+			dirs = directions[:, i]
+			dirs[:, 0] = UP
+			dirs[:, 1:] = DIAG
+			dirs[:, 1:][row[:, 1:] == up] = UP
+			dirs[:, 1:][row[:, 1:] == row[:, :-1]] = LEFT
+
+		done = byDepth[ends[i]:ends[i+1]]
+		scores[done] = row[done, len1[done]] + offsets[len1[done]]
+		prev, row = row, prev
+
+	alignments = None
+	if traceback:
+		alignments = [traceDirections(firsts[k],seconds[k],directions[k]) for k in range(num)]
+	return scores, alignments
+
+def checkedRecords(infile,characters):
+
+	charset = set(characters)
+	for name,seq in readFasta(infile):
+		if not set(seq) <= charset:
+			raise AttributeError("Invalid character in sequence file!")
+		yield name[1:].strip(), seq
+
+def alignPairs(records,lookup,matrix,gap,lanes=256,traceback=False):
+
+	#records alternate first and second sequence of each pair; pairs are yielded back in input order
+	while True:
+		chunk = list(itertools.islice(records, 2 * lanes * 32))
+		if not chunk:
+			return
+		pairs = [(chunk[x], chunk[x+1]) for x in range(0, len(chunk) - 1, 2)]
+
+		#similar lengths share a sweep so little of each sweep is padding
+		order = sorted(range(len(pairs)), key=lambda k: (len(pairs[k][0][1]) // 32, len(pairs[k][1][1])))
+		results = [None] * len(pairs)
+		for start in range(0, len(order), lanes):
+			batch = order[start:start+lanes]
+			firsts = [pairs[k][0][1] for k in batch]
+			seconds = [pairs[k][1][1] for k in batch]
+			scores, alignments = batchAlign(firsts,seconds,lookup,matrix,gap,traceback)
+			for x in range(len(batch)):
+				if traceback:
+					results[batch[x]] = (int(scores[x]),) + alignments[x]
+				else:
+					results[batch[x]] = (int(scores[x]),)
+
+		for k in range(len(pairs)):
+			yield pairs[k][0][0], pairs[k][1][0], results[k]
+		if len(chunk) % 2:
+			raise IOError("Record " + chunk[-1][0] + " has no partner to be aligned with!")
+
+def alignNumpy(firststr,secondstr,characters,scorelist,gap):
+
+	lookup, matrix = encodeMatrix(characters,scorelist)
+	codes1 = encodeSequence(firststr,lookup)
+	codes2 = encodeSequence(secondstr,lookup)
+
+	directions = np.empty((len(secondstr)+1, len(firststr)+1), dtype=np.uint8)
+	lastRow = fillNumpy(codes1,codes2,matrix,gap,directions)
+	align1, align2 = traceDirections(firststr,secondstr,directions)
+	return align1, align2, int(lastRow[-1])
+
+def readMatrix(fileName):
+
+	matrixFile = open(fileName)
 	characters = matrixFile.readline().upper()
 	
 	
-	#ERROR CHECKING BEGINS HERE ----------------
 	nonchars = re.search(r"^[a-zA-Z]", characters)
 	
 	if not nonchars:
@@ -205,6 +704,454 @@ def main():
 		raise TypeError("Too many lines in matrix file!")
 	
 	matrixFile.close()
+	return characters, scores, gapScore
+
+def checkSequence(seq,characters):
+
+	for char in seq:
+		if not char in characters:
+			raise AttributeError("Invalid character in sequence file!")
+
+def alignScore(firststr,secondstr,scorelist,gap):
+
+	#score of the best global alignment, keeping only the previous row
+	len1 = len(firststr)
+	prev = [gap * x for x in range(len1+1)]
+	for i in range(1, len(secondstr)+1):
+		char2 = secondstr[i-1]
+		row = [gap * i]
+		for j in range(1, len1+1):
+			row.append(max(prev[j-1] + scorelist[firststr[j-1] + char2], row[j-1] + gap, prev[j] + gap))
+		prev = row
+	return prev[len1]
+
+#per-process state for allPairs, set once by initPairWorker so the matrix and sequences are not resent with every chunk
+pairState = {}
+
+def initPairWorker(seqs,characters,scorelist,gap):
+
+	pairState["seqs"] = seqs
+	pairState["scores"] = scorelist
+	pairState["gap"] = gap
+	if np is not None:
+		lookup, matrix = encodeMatrix(characters,scorelist)
+		pairState["matrix"] = matrix
+		pairState["codes"] = [encodeSequence(seq,lookup) for seq in seqs]
+
+def scorePair(i,j):
+
+	if np is not None:
+		codes = pairState["codes"]
+		return int(fillNumpy(codes[i],codes[j],pairState["matrix"],pairState["gap"])[-1])
+	seqs = pairState["seqs"]
+	return alignScore(seqs[i],seqs[j],pairState["scores"],pairState["gap"])
+
+def scoreChunk(pairs):
+
+	return [(i, j, scorePair(i,j)) for i,j in pairs]
+
+def pairChunks(num,chunk):
+
+	pairs = []
+	for i in range(num):
+		for j in range(i, num):
+			pairs.append((i,j))
+			if len(pairs) == chunk:
+				yield pairs
+				pairs = []
+	if pairs:
+		yield pairs
+
+def pairIndex(i,j,num):
+
+	#position of pair i <= j in the upper triangle (diagonal included), stored row by row
+	return i * num - i * (i - 1) // 2 + (j - i)
+
+def allPairs(seqs,characters,scorelist,gap,processes=None,chunk=1000):
+
+	#scores are kept unboxed in one array covering the upper triangle, not as N x N lists
+	num = len(seqs)
+	scores = array.array('l', [0]) * (num * (num + 1) // 2)
+
+	#score every pair (including each sequence against itself) across a pool of worker processes
+	pool = multiprocessing.Pool(processes, initPairWorker, (seqs,characters,scorelist,gap))
+	for results in pool.imap_unordered(scoreChunk, pairChunks(num,chunk)):
+		for i,j,score in results:
+			scores[pairIndex(i,j,num)] = score
+	pool.close()
+	pool.join()
+	return scores
+
+def distanceRows(scores,num):
+
+	#distance is one minus the score relative to the mean self-score of the two sequences;
+	#rows are built one at a time as they are written
+	for i in range(num):
+		row = []
+		for j in range(num):
+			if i == j:
+				row.append(0.0)
+				continue
+			norm = (scores[pairIndex(i,i,num)] + scores[pairIndex(j,j,num)]) * 0.5
+			if norm > 0:
+				row.append(max(0.0, 1.0 - scores[pairIndex(min(i,j),max(i,j),num)] / norm))
+			else:
+				row.append(1.0)
+		yield row
+
+def writeDist(outfile,names,rows):
+
+	#same layout as the EMBOSS distmat files read by UPGMA.py importDist
+	for name,row in itertools.izip(names,rows):
+		line = ["%20s" % name]
+		for dist in row:
+			line.append(" %9g" % dist)
+		outfile.write(''.join(line) + '\n')
+
+def readDatabase(dbFile):
+
+	names = []
+	seqs = []
+	residues = set()
+	infile = open(dbFile)
+	for name,seq in readFasta(infile):
+		names.append(name[1:].strip())
+		seqs.append(seq)
+		residues.update(seq)
+	infile.close()
+	return names, seqs, residues
+
+def buildIndex(dbFile,k):
+
+	names, seqs, residues = readDatabase(dbFile)
+
+	#every k-mer maps to the (record << 32 | position) of its occurrences
+	table = {}
+	for rec in range(len(seqs)):
+		seq = seqs[rec]
+		for pos in range(len(seq) - k + 1):
+			kmer = seq[pos:pos+k]
+			entries = table.get(kmer)
+			if entries is None:
+				entries = table[kmer] = array.array('l')
+			entries.append((rec << 32) | pos)
+
+	stat = os.stat(dbFile)
+	return {"k": k, "names": names, "seqs": seqs, "residues": residues, "table": table, "source": (stat.st_size, stat.st_mtime)}
+
+def saveIndex(indexFile,index):
+
+	#plain data only: a header line (k and the size and time of the database it was built from), the k-mers
+	#back to back, then the number of entries of each k-mer and all the entries as raw array('l') dumps
+	table = index["table"]
+	kmers = sorted(table)
+	size, mtime = index["source"]
+	outfile = open(indexFile, "wb")
+	outfile.write("%s %d %d %r %d\n" % (INDEXMAGIC, index["k"], size, mtime, len(kmers)))
+	outfile.write(''.join(kmers))
+	array.array('l', [len(table[kmer]) for kmer in kmers]).tofile(outfile)
+	for kmer in kmers:
+		table[kmer].tofile(outfile)
+	outfile.close()
+
+def readIndexTable(indexFile,k,source):
+
+	#the k-mer table of a saved index, or None if it was built with another k or from an older database file
+	infile = open(indexFile, "rb")
+	try:
+		header = infile.readline().split()
+		if len(header) != 5 or header[0] != INDEXMAGIC:
+			return None
+		if int(header[1]) != k or (int(header[2]), float(header[3])) != source:
+			return None
+		num = int(header[4])
+		kmers = infile.read(num * k)
+		if len(kmers) != num * k:
+			return None
+		counts = array.array('l')
+		counts.fromfile(infile, num)
+		entries = array.array('l')
+		entries.fromfile(infile, sum(counts))
+	finally:
+		infile.close()
+
+	table = {}
+	start = 0
+	for x in range(num):
+		table[kmers[x*k:(x+1)*k]] = entries[start:start+counts[x]]
+		start += counts[x]
+	return table
+
+def loadIndex(dbFile,indexFile,k):
+
+	#reuse the saved index unless it is unreadable, was built with another k or from an older database file
+	stat = os.stat(dbFile)
+	source = (stat.st_size, stat.st_mtime)
+	try:
+		table = readIndexTable(indexFile,k,source)
+	except Exception:
+		table = None
+	if table is not None:
+		names, seqs, residues = readDatabase(dbFile)
+		return {"k": k, "names": names, "seqs": seqs, "residues": residues, "table": table, "source": source}
+
+	index = buildIndex(dbFile,k)
+	try:
+		saveIndex(indexFile,index)
+	except (IOError, OSError):
+		sys.stderr.write("Could not save the index to " + indexFile + ", continuing without it\n")
+	return index
+
+def extendSeed(query,target,qpos,tpos,k,scorelist,xdrop):
+
+	score = 0
+	for x in range(k):
+		score += scorelist[query[qpos+x] + target[tpos+x]]
+
+	#ungapped x-drop extension to the right of the seed
+	right = 0
+	best = 0
+	run = 0
+	x = k
+	while qpos + x < len(query) and tpos + x < len(target):
+		run += scorelist[query[qpos+x] + target[tpos+x]]
+		x += 1
+		if run > best:
+			best = run
+			right = x - k
+		elif best - run > xdrop:
+			break
+	score += best
+
+	#and to the left
+	left = 0
+	best = 0
+	run = 0
+	x = 1
+	while qpos - x >= 0 and tpos - x >= 0:
+		run += scorelist[query[qpos-x] + target[tpos-x]]
+		if run > best:
+			best = run
+			left = x
+		elif best - run > xdrop:
+			break
+		x += 1
+	score += best
+
+	return score, qpos - left, qpos + k + right, tpos - left, tpos + k + right
+
+def searchIndex(query,index,scorelist,xdrop=20,window=40):
+
+	k = index["k"]
+	table = index["table"]
+	seqs = index["seqs"]
+
+	lastHit = {}
+	covered = {}
+	best = {}
+
+	#work is proportional to the number of k-mer hits, not to the size of the database
+	for qpos in range(len(query) - k + 1):
+		entries = table.get(query[qpos:qpos+k])
+		if entries is None:
+			continue
+		for entry in entries:
+			rec = entry >> 32
+			tpos = entry & 0xffffffff
+			diagonal = (rec, tpos - qpos)
+
+			#skip seeds already inside an extended hit on this diagonal
+			if covered.get(diagonal, -1) > qpos:
+				continue
+
+			#two-hit rule: extend only when an earlier, non-overlapping hit on the diagonal is close by
+			if window:
+				last = lastHit.get(diagonal)
+				if last is not None and qpos - last < k:
+					continue
+				lastHit[diagonal] = qpos
+				if last is None or qpos - last > window:
+					continue
+
+			hit = extendSeed(query,seqs[rec],qpos,tpos,k,scorelist,xdrop)
+			covered[diagonal] = hit[2]
+			if rec not in best or hit[0] > best[rec][0]:
+				best[rec] = hit
+
+	ranked = sorted(best.items(), key=lambda item: (-item[1][0], item[0]))
+	return [(rec,) + hit for rec,hit in ranked]
+
+def runSearch(matrixName,queryName,dbName,options):
+
+	characters, scores, gapScore = readMatrix(matrixName)
+	k = int(options.get("k", 3))
+	numHits = int(options.get("hits", 20))
+	xdrop = int(options.get("xdrop", 20))
+	window = int(options.get("window", 40))
+
+	index = loadIndex(dbName,options.get("index", dbName + ".kmi"),k)
+	for char in index["residues"]:
+		if not char in characters:
+			raise AttributeError("Invalid character in database file!")
+
+	queryFile = open(queryName)
+	for name,query in readFasta(queryFile):
+		checkSequence(query,characters)
+		print "Query: " + name[1:].strip()
+		hits = searchIndex(query,index,scores,xdrop,window)
+		for rank in range(min(numHits, len(hits))):
+			rec, score, qstart, qend, tstart, tend = hits[rank]
+			print "%d\t%d\t%s\t%d-%d\t%d-%d" % (rank+1, score, index["names"][rec], qstart+1, qend, tstart+1, tend)
+		print ""
+	queryFile.close()
+
+def randomScheme(characters,rng):
+
+	#random symmetric substitution scores, positive on the diagonal, so ties between moves are common
+	scorelist = {}
+	for a in characters:
+		for b in characters:
+			if a + b not in scorelist:
+				if a == b:
+					scorelist[a + b] = rng.randint(1, 6)
+				else:
+					scorelist[a + b] = scorelist[b + a] = rng.randint(-4, 2)
+	return scorelist
+
+def testEngines(trials=200):
+
+	#every engine must give the alignment and score of prepMatrix + traceDirections, ties included
+	rng = random.Random(1)
+	protein = "ARNDCQEGHILKMFPSTWYV"
+	dna = "ACGT"
+	unitCost = dict((a + b, 0 if a == b else -1) for a in dna for b in dna)
+	cases = []
+	for trial in range(trials):
+		if trial % 2:
+			characters, scorelist, gap = dna, unitCost, -1
+		else:
+			characters, scorelist, gap = protein, randomScheme(protein,rng), rng.randint(-5, -1)
+		len1 = rng.randint(0, 40)
+		len2 = max(0, len1 + rng.randint(-10, 10))
+		firststr = ''.join(rng.choice(characters) for x in range(len1))
+		secondstr = ''.join(rng.choice(characters) for x in range(len2))
+		cases.append((characters, scorelist, gap, firststr, secondstr))
+
+	for characters, scorelist, gap, firststr, secondstr in cases:
+		arr, directions = prepMatrix(firststr,secondstr,scorelist,gap)
+		expected = traceDirections(firststr,secondstr,directions) + (arr[len(secondstr)+1][len(firststr)+1],)
+
+		directions, score = alignBlock(firststr,secondstr,scorelist,gap)
+		assert traceDirections(firststr,secondstr,directions) + (score,) == expected, "alignBlock() test failed"
+		assert alignScore(firststr,secondstr,scorelist,gap) == expected[2], "alignScore() test failed"
+		assert hirschberg(firststr,secondstr,scorelist,gap) == expected, "hirschberg() test failed"
+		assert bandedAlign(firststr,secondstr,scorelist,gap,1)[:3] == expected, "bandedAlign() test failed"
+
+		scheme = unitCostScheme(characters,scorelist,gap)
+		if scheme is not None:
+			align1, align2, dist = myersAlign(firststr,secondstr)
+			assert (align1, align2, myersScore(scheme,gap,len(firststr),len(secondstr),dist)) == expected, "myersAlign() test failed"
+			assert myersColumns(firststr,secondstr) == dist, "myersColumns() test failed"
+
+		if np is not None:
+			assert alignNumpy(firststr,secondstr,characters,scorelist,gap) == expected, "alignNumpy() test failed"
+
+	#batched lanes of different lengths, one batch per scoring scheme
+	if np is not None:
+		for characters, scorelist, gap in ((protein, randomScheme(protein,rng), -4), (dna, unitCost, -1)):
+			firsts = [''.join(rng.choice(characters) for x in range(rng.randint(0, 40))) for k in range(50)]
+			seconds = [''.join(rng.choice(characters) for x in range(rng.randint(0, 40))) for k in range(50)]
+			lookup, matrix = encodeMatrix(characters,scorelist)
+			scores, alignments = batchAlign(firsts,seconds,lookup,matrix,gap,True)
+			for k in range(len(firsts)):
+				arr, directions = prepMatrix(firsts[k],seconds[k],scorelist,gap)
+				assert int(scores[k]) == arr[len(seconds[k])+1][len(firsts[k])+1], "batchAlign() score test failed"
+				assert tuple(alignments[k]) == traceDirections(firsts[k],seconds[k],directions), "batchAlign() traceback test failed"
+
+	print "Alignment engine tests passed!"
+
+def parseOptions(argv):
+
+	#split command line into positional arguments and --option or --option=value flags
+	args = []
+	options = {}
+	for arg in argv:
+		if arg.startswith("--"):
+			key, sep, value = arg[2:].partition("=")
+			if sep:
+				options[key] = value
+			else:
+				options[key] = True
+		else:
+			args.append(arg)
+	return args, options
+
+def main():
+
+	# Read from command line and check for valid input files
+	args, options = parseOptions(sys.argv[1:])
+
+	if "test" in options:
+		testEngines()
+		return
+
+	if args and args[0] == "search":
+		if len(args) < 4:
+			print "Not enough arguments! Need matrix file, query file and database file."
+			sys.exit()
+		runSearch(args[1],args[2],args[3],options)
+		return
+
+	if len(args) < 2:
+		print "Not enough arguments! Need input file and output file."
+		sys.exit()
+		
+	input1File = args[0]
+	input2File = args[1]
+		
+	try:
+		infile = open(input1File)
+	except IOError:
+		print "The input file does not exist!"
+		sys.exit()
+
+	try:
+		infile = open(input2File)
+	except IOError:
+		print "The output file does not exist!"
+		sys.exit()
+
+	# Parse the matrix file
+	#ERROR CHECKING BEGINS HERE ----------------
+	characters, scores, gapScore = readMatrix(input1File)
+
+	if "pairs" in options:
+		if np is None:
+			print "NumPy is required for --pairs!"
+			sys.exit()
+		lookup, matrix = encodeMatrix(characters,scores)
+		if options["pairs"] is True:
+			outfile = sys.stdout
+		else:
+			outfile = open(options["pairs"], "w")
+		stringFile = open(input2File)
+
+		records = checkedRecords(stringFile,characters)
+		output = []
+		for name1,name2,result in alignPairs(records,lookup,matrix,gapScore,int(options.get("lanes", 256)),"traceback" in options):
+			if "traceback" in options:
+				output.append("%s\t%s\t%d\n%s\n%s\n" % (name1, name2, result[0], result[1], result[2]))
+			else:
+				output.append("%s\t%s\t%d\n" % (name1, name2, result[0]))
+			if len(output) >= 10000:
+				outfile.write(''.join(output))
+				output = []
+		outfile.write(''.join(output))
+
+		stringFile.close()
+		if outfile is not sys.stdout:
+			outfile.close()
+		return
 
 	# Parse the sequence file
 	stringFile = open(input2File)
@@ -217,6 +1164,22 @@ def main():
 	
 	if len(seqList) < 2:
 		raise IOError("Not enough input sequences!")
+
+	if "all" in options:
+		for name,seq in seqList:
+			checkSequence(seq,characters)
+		#whole headers, with spaces as underscores, so taxa stay distinct and importDist can still split the rows
+		names = ["_".join(name[1:].split()) for name,seq in seqList]
+		seqs = [seq for name,seq in seqList]
+		pairScores = allPairs(seqs,characters,scores,gapScore,int(options.get("processes", 0)) or None,int(options.get("chunk", 1000)))
+		distances = distanceRows(pairScores,len(seqs))
+		if options["all"] is True:
+			writeDist(sys.stdout,names,distances)
+		else:
+			outfile = open(options["all"], "w")
+			writeDist(outfile,names,distances)
+			outfile.close()
+		return
 	
 	SEQ1LOC		= 0
 	SEQ2LOC		= 1
@@ -231,21 +1194,65 @@ def main():
 	len1 = len(string1)	
 	len2 = len(string2)
 	
-	for char in string1:
-		if not char in characters:
-			raise AttributeError("Invalid character in sequence file!")
-	
-	for char in string2:
-		if not char in characters:
-			raise AttributeError("Invalid character in sequence file!")
+	checkSequence(string1,characters)
+	checkSequence(string2,characters)
 			
 	#ERROR CHECKING ENDS HERE ---------------
 
-	# Computes the alignment score matrix
-	arr = prepMatrix(string1,string2,scores,gapScore)
-	
-	# Prints out the alignment
-	printAlignment(string1name,string1,string2name,string2,arr,gapScore)
+	if "numpy" in options:
+		if np is None:
+			print "NumPy is required for --numpy!"
+			sys.exit()
+		align1, align2, score = alignNumpy(string1,string2,characters,scores,gapScore)
+		printAligned(string1name,align1,string2name,align2,score)
+		return
+
+	if "band" in options:
+		if options["band"] is True:
+			align1, align2, score, band = bandedAlign(string1,string2,scores,gapScore)
+		else:
+			align1, align2, score, band = bandedAlign(string1,string2,scores,gapScore,int(options["band"]))
+		printAligned(string1name,align1,string2name,align2,score)
+		print "Band width: " + str(band)
+		return
+
+	if "hirschberg" in options:
+		align1, align2, score = hirschberg(string1,string2,scores,gapScore)
+		printAligned(string1name,align1,string2name,align2,score)
+		return
+
+	scheme = unitCostScheme(characters,scores,gapScore)
+	engines = ["numpy", "hirschberg", "band", "dump"]
+	if "myers" in options or (scheme is not None and not [engine for engine in engines if engine in options]):
+		if scheme is None:
+			print "--myers needs a matrix with one match and one mismatch score, and gap = match/2 - (match - mismatch)!"
+			sys.exit()
+		if "score" in options:
+			dist = myersColumns(string1,string2)
+			print "Alignment score: " + str(myersScore(scheme,gapScore,len1,len2,dist))
+		else:
+			align1, align2, dist = myersAlign(string1,string2)
+			printAligned(string1name,align1,string2name,align2,myersScore(scheme,gapScore,len1,len2,dist))
+		print "Edit distance: " + str(dist)
+		return
+
+	if "score" in options:
+		if np is not None:
+			lookup, matrix = encodeMatrix(characters,scores)
+			score = int(fillNumpy(encodeSequence(string1,lookup),encodeSequence(string2,lookup),matrix,gapScore)[-1])
+		else:
+			score = alignScore(string1,string2,scores,gapScore)
+		print "Alignment score: " + str(score)
+		return
+
+	if "dump" in options:
+		# Computes the alignment score matrix, printed along with the alignment
+		arr, directions = prepMatrix(string1,string2,scores,gapScore)
+		printAlignment(string1name,string1,string2name,string2,directions,arr[len2+1][len1+1],arr)
+	else:
+		# Computes only the traceback directions and the score
+		directions, score = alignBlock(string1,string2,scores,gapScore)
+		printAlignment(string1name,string1,string2name,string2,directions,score)
 
 if __name__ == "__main__":
 	main()
@@ -3,10 +3,37 @@ import sys
 import string
 import textwrap
 import math
+import struct
+import array
+import cStringIO
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
 
 '''
 Input: UPGMA.py [distmat file]
-Output: Newick format tree generated with UPGMA algorithm.
+Output: Newick format tree generated with UPGMA algorithm (or neighbor joining, with --nj).
+
+Options:
+--numpy		cluster over a NumPy matrix with cached row minima and reused slots, O(N^2) time in practice
+		instead of O(N^3 log N); gives the same tree for distance matrices with a zero diagonal
+--convert=out	write the text distmat to out in the binary condensed format (float32 upper triangle) and exit;
+		a condensed file given as input is memory-mapped and clustered like --numpy, without parsing
+--linkage=file	also save the merges with numpy.save as an (N-1) x 4 float64 array, like a SciPy linkage matrix:
+		first child, second child, height, size; leaves are 0 .. N-1 and merge k creates node N + k
+--save=file	also save the tree (linkage, merge distances and names) with numpy.savez, for --insert
+--insert=file	add the taxa of the input file to the tree saved in file instead of clustering from scratch; each
+		line is a name and its distances to every taxon already in the tree, in tree order (earlier lines
+		of the file included). The taxon's distances to all clusters take one O(N) pass, then only the merge
+		distances on the path above its insertion point are updated, in a single walk up the path. Exact for
+		ultrametric distances; otherwise the kept subtrees are treated as equidistant to their path siblings
+		and keep their saved merge order
+--test		check the NumPy, condensed, neighbor-joining and insertion engines against the reference
+		algorithms on random matrices and exit
+--nj		build a neighbor-joining tree instead, searching the Q-matrix RapidNJ style through sorted rows
+		with upper-bound pruning; the unrooted tree ends in a three-way join
 '''
 
 
@@ -48,20 +75,26 @@ def importDist(fileName):
 			
 def errorCheck():
 	#check if more than one argument was provided
-	if len(sys.argv) < 2:
+	args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	if len(args) < 1:
 		print "No file name provided!"
 		sys.exit()
 	
-	if len(sys.argv) > 3:
+	if len(args) > 2:
 		print "Too many arguments!"
 		sys.exit()
 		
-def upgma(scoreMatrix, N, Name):
+def upgmaLinkage(scoreMatrix, N):
 
-	#intialize a height matrix
+	#intialize a height matrix, and the node ids and sizes of the clusters in the list
 	H = []
 	for i in range(N):
 		H.append(0)
+	ids = range(N)
+	sizes = [1] * N
+
+	#each merge is recorded as [first child id, second child id, height, size]; merge k makes node N + k
+	linkage = []
 		
 	
 	while (len(scoreMatrix)>1):
@@ -116,16 +149,20 @@ def upgma(scoreMatrix, N, Name):
 		Hnew = (H[currentIndex]+H[currentIndex2]+current)*0.5
 		H.append(Hnew)
 		
-		#name the new node
-		newName = "(" + Name[currentIndex] + ":" + str(Hnew-H[currentIndex]) + "," + Name[currentIndex2] + ":" + str(Hnew-H[currentIndex2]) + ")"
-		Name.append(newName)
+		#record the merge and give the new node the next id
+		size = sizes[currentIndex] + sizes[currentIndex2]
+		linkage.append([ids[currentIndex], ids[currentIndex2], Hnew, size])
+		ids.append(N + len(linkage) - 1)
+		sizes.append(size)
 		
 		
-		#these deletions help keep all three matrices consistent in terms of size: scoreMatrix, Name, H
+		#these deletions help keep all four lists consistent in terms of size: scoreMatrix, ids, sizes, H
 		
-		#delete names of nodes that were combined
-		del Name[currentIndex]
-		del Name[currentIndex2-1]
+		#delete ids and sizes of nodes that were combined
+		del ids[currentIndex]
+		del ids[currentIndex2-1]
+		del sizes[currentIndex]
+		del sizes[currentIndex2-1]
 		
 		#delete heights of nodes that were combined
 		del H[currentIndex]
@@ -133,12 +170,674 @@ def upgma(scoreMatrix, N, Name):
 		
 		
 		
-	return Name[0]
+	return linkage
+
+def upgma(scoreMatrix, N, Name):
+	return newickString(upgmaLinkage(scoreMatrix, N), Name)
+
+#write the tree of a linkage as Newick without recursion or nested string copies; children are written in
+#linkage order with branch lengths from the heights, so the text is the same one upgma() used to build
+def writeNewick(outfile, linkage, Name, labels=None):
+	#labels, if given, holds a label per merge (None for no label) written after its closing parenthesis
+	N = len(linkage) + 1
+	if np is not None and isinstance(linkage, np.ndarray):
+		linkage = linkage.tolist()
+	heights = [0.0] * N + [merge[2] for merge in linkage]
+
+	buf = []
+	buffered = 0
+	stack = [2 * N - 2]
+	while stack:
+		item = stack.pop()
+		if isinstance(item, str):
+			buf.append(item)
+		elif item < N:
+			buf.append(Name[item])
+		else:
+			a, b, height, size = linkage[item - N]
+			a = int(a)
+			b = int(b)
+			close = ")"
+			if labels is not None and labels[item - N] is not None:
+				close = ")" + labels[item - N]
+			stack.extend([close, ":" + str(height - heights[b]), b, ",", ":" + str(height - heights[a]), a])
+			buf.append("(")
+		buffered += 1
+		if buffered >= 65536:
+			outfile.write(''.join(buf))
+			buf = []
+			buffered = 0
+	outfile.write(''.join(buf))
+
+def newickString(linkage, Name):
+	out = cStringIO.StringIO()
+	writeNewick(out, linkage, Name)
+	return out.getvalue()
 		
+#binary condensed distance matrix: header of magic, N and the offset of the names, then the upper triangle as
+#float32 stored column by column (D[i][j], i < j, at j*(j-1)/2 + i, so taxa can be appended), then the names
+CONDENSEDMAGIC = "UPGMADM1"
+CONDENSEDHEADER = "<8sQQ"
+
+#positions in the condensed triangle of D[i][k] for every k in idx (k == i gives position 0, a placeholder)
+def condensedPositions(i, idx):
+	lo = np.minimum(idx, i)
+	hi = np.maximum(idx, i)
+	return np.where(hi > lo, hi * (hi - 1) // 2 + lo, 0)
+
+def isCondensed(fileName):
+	infile = open(fileName, 'rb')
+	magic = infile.read(len(CONDENSEDMAGIC))
+	infile.close()
+	return magic == CONDENSEDMAGIC
+
+#one-time conversion of a text distmat; row j of the text gives column j of the triangle, so it streams in one pass
+def convertDist(fileName, outName):
+	outfile = open(outName, 'wb')
+	outfile.write(struct.pack(CONDENSEDHEADER, CONDENSEDMAGIC, 0, 0))
+	Name = []
+	for line in open(fileName):
+		line = line.strip().split()
+		if not line:
+			continue
+		j = len(Name)
+		array.array('f', [float(value) for value in line[1:j+1]]).tofile(outfile)
+		Name.append(line[0])
+	namesOffset = outfile.tell()
+	outfile.write("\n".join(Name))
+	outfile.seek(0)
+	outfile.write(struct.pack(CONDENSEDHEADER, CONDENSEDMAGIC, len(Name), namesOffset))
+	outfile.close()
+
+#FASTA records as (header line, sequence), read one at a time; shared by the distance tools in this directory
+def readFasta(infile):
+	name, seq = None, []
+	for line in infile:
+		if line.startswith(">"):
+			if name:
+				yield(name, ''.join(seq))
+			name, seq = line.strip(), []
+		else:
+			seq.append(line.strip())
+	if name:
+		yield (name, ''.join(seq))
+
+#value of a --name=value option, or default
+def optionValue(argv, name, default=None):
+	for arg in argv:
+		if arg.startswith("--" + name + "="):
+			return arg.split("=", 1)[1]
+	return default
+
+#write the rows of a lower triangle (row i holding distances to taxa 0 .. i-1) as a condensed file, as they arrive
+def writeCondensed(outName, Name, rows):
+
+	#row j of the lower triangle is column j of the condensed upper triangle, so it streams straight out
+	outfile = open(outName, 'wb')
+	outfile.write(struct.pack(CONDENSEDHEADER, CONDENSEDMAGIC, 0, 0))
+	for row in rows:
+		np.asarray(row, dtype=np.float32).tofile(outfile)
+	namesOffset = outfile.tell()
+	outfile.write("\n".join(Name))
+	outfile.seek(0)
+	outfile.write(struct.pack(CONDENSEDHEADER, CONDENSEDMAGIC, len(Name), namesOffset))
+	outfile.close()
+
+#write the rows of a lower triangle as a text distmat
+def writeDist(outfile, Name, rows):
+
+	#same layout as the EMBOSS distmat files read by importDist; the rows are kept as one condensed array
+	#(column j of the triangle is row j) and each full row is gathered from it when it is written
+	N = len(Name)
+	rows = [np.asarray(row, dtype=np.float64) for row in rows]
+	cond = np.concatenate(rows) if rows else np.zeros(0)
+	slots = np.arange(N)
+	for i in range(N):
+		distances = cond[condensedPositions(i, slots)] if N > 1 else np.zeros(N)
+		distances[i] = 0.0
+		line = ["%20s" % Name[i]]
+		for dist in distances.tolist():
+			line.append(" %9g" % dist)
+		outfile.write(''.join(line) + '\n')
+
+#map a condensed file copy-on-write, so clustering can update it in place without touching the file
+def importCondensed(fileName):
+	infile = open(fileName, 'rb')
+	magic, N, namesOffset = struct.unpack(CONDENSEDHEADER, infile.read(struct.calcsize(CONDENSEDHEADER)))
+	infile.seek(namesOffset)
+	Name = infile.read().split("\n")
+	infile.close()
+	if N < 2:
+		return (np.zeros(0, dtype=np.float32), N, Name)
+	cond = np.memmap(fileName, dtype=np.float32, mode='c', offset=struct.calcsize(CONDENSEDHEADER), shape=(N*(N-1)//2,))
+	return (cond, N, Name)
+
+def upgmaNumpyLinkage(scoreMatrix, N, condensed=False):
+
+	#each cluster keeps a slot; the merged pair's first slot is reused for the new node and the second retired.
+	#retired slots and the diagonal read as infinity so a plain row minimum is the nearest other cluster
+	active = np.ones(N, dtype=bool)
+	if condensed:
+		cond = scoreMatrix
+		slots = np.arange(N)
+
+		def row(i):
+			values = cond[condensedPositions(i, slots)].astype(np.float64)
+			values[~active] = np.inf
+			values[i] = np.inf
+			return values
+
+		def column(i, idx):
+			return cond[condensedPositions(i, idx)].astype(np.float64)
+
+		def store(i, idx, values):
+			cond[condensedPositions(i, idx)] = values
+
+		def retire(i):
+			pass
+
+		#row minima a column of the triangle at a time, so the file is read through once in order
+		rowMin = np.empty(N)
+		rowMin.fill(np.inf)
+		for j in range(1, N):
+			values = cond[j*(j-1)//2:j*(j-1)//2+j]
+			rowMin[j] = values.min()
+			np.minimum(rowMin[:j], values, rowMin[:j])
+		dtype = np.float32
+	else:
+		D = np.array(scoreMatrix, dtype=np.float64).reshape(N, N)
+		np.fill_diagonal(D, np.inf)
+
+		def row(i):
+			return D[i]
+
+		def column(i, idx):
+			return D[idx, i]
+
+		def store(i, idx, values):
+			D[i, idx] = values
+			D[idx, i] = values
+
+		def retire(i):
+			D[i, :] = np.inf
+			D[:, i] = np.inf
+
+		rowMin = D.min(axis=1)
+		dtype = np.float64
+
+	H = [0.0] * N
+	sizes = [1] * N
+	linkage = np.zeros((max(0, N - 1), 4))
+
+	#upgma() keeps its clusters in a list with new nodes appended at the end, so a slot's place in that list
+	#is simply the node id it holds
+	order = np.arange(N)
+
+	for step in range(N - 1):
+		#first row in list order with the lowest score, and the last column in list order where it occurs
+		current = float(rowMin.min())
+		rows = np.flatnonzero(rowMin == current)
+		currentIndex = rows[np.argmin(order[rows])]
+		currentRow = row(currentIndex)
+		cols = np.flatnonzero(currentRow == current)
+		currentIndex2 = cols[np.argmax(order[cols])]
+
+		#distances to the new node, computed from the two merged rows exactly as upgma() does
+		#(and rounded to the storage type, so cached minima always equal stored values)
+		others = np.flatnonzero(active)
+		others = others[(others != currentIndex) & (others != currentIndex2)]
+		newDist = ((currentRow[others] + row(currentIndex2)[others]) * 0.5).astype(dtype).astype(np.float64)
+		oldMin = rowMin[others]
+		stale = (column(currentIndex, others) == oldMin) | (column(currentIndex2, others) == oldMin)
+
+		retire(currentIndex2)
+		active[currentIndex2] = False
+		rowMin[currentIndex2] = np.inf
+		store(currentIndex, others, newDist)
+
+		#a row's cached minimum only needs a rescan if it sat in one of the two merged columns
+		rowMin[others] = np.minimum(oldMin, newDist)
+		for i in others[stale]:
+			rowMin[i] = row(i).min()
+		rowMin[currentIndex] = newDist.min() if len(others) else np.inf
+
+		#update the heights and record the merge
+		Hnew = (H[currentIndex]+H[currentIndex2]+current)*0.5
+		size = sizes[currentIndex] + sizes[currentIndex2]
+		linkage[step] = [order[currentIndex], order[currentIndex2], Hnew, size]
+		H[currentIndex] = Hnew
+		sizes[currentIndex] = size
+		order[currentIndex] = N + step
+
+	return linkage
+
+def upgmaNumpy(scoreMatrix, N, Name, condensed=False):
+	return newickString(upgmaNumpyLinkage(scoreMatrix, N, condensed), Name)
+
+#columns of the sorted rows examined per pass of the neighbor-joining search
+NJBLOCK = 16
+
+#full symmetric float64 matrix from a condensed triangle
+def expandCondensed(cond, N):
+	D = np.zeros((N, N))
+	for j in range(1, N):
+		D[:j, j] = cond[j*(j-1)//2:j*(j-1)//2+j]
+		D[j, :j] = D[:j, j]
+	return D
+
+#write a neighbor-joining tree as Newick without recursion or nested string copies, the same way as writeNewick;
+#joins[k] = (a, va, b, vb) joins nodes a and b into node N + k, root lists the (node, branch length) of the
+#last join, which has three children (two for N = 2, none for a single taxon)
+def writeJoins(outfile, joins, root, Name):
+	N = len(Name)
+	if not root:
+		outfile.write(Name[0])
+		return
+
+	stack = [")"]
+	for x in range(len(root) - 1, -1, -1):
+		stack.extend([":" + str(root[x][1]), root[x][0]])
+		if x > 0:
+			stack.append(",")
+	buf = ["("]
+	buffered = 0
+	while stack:
+		item = stack.pop()
+		if isinstance(item, str):
+			buf.append(item)
+		elif item < N:
+			buf.append(Name[item])
+		else:
+			a, va, b, vb = joins[item - N]
+			stack.extend([")", ":" + str(vb), b, ",", ":" + str(va), a])
+			buf.append("(")
+		buffered += 1
+		if buffered >= 65536:
+			outfile.write(''.join(buf))
+			buf = []
+			buffered = 0
+	outfile.write(''.join(buf))
+
+def neighborJoin(scoreMatrix, N, Name):
+	(joins, root) = neighborJoinTree(scoreMatrix, N)
+	out = cStringIO.StringIO()
+	writeJoins(out, joins, root, Name)
+	return out.getvalue()
+
+def neighborJoinTree(scoreMatrix, N):
+
+	#neighbor joining with the RapidNJ search: every row keeps its distances sorted (S) with the node ids they
+	#belong to (I), and is only read until (r-2)*S - R[i] - max(R) can no longer beat the best Q found so far
+	D = np.array(scoreMatrix, dtype=np.float64).reshape(N, N)
+	joins = []
+	if N < 3:
+		if N == 2:
+			half = float(D[0, 1]) * 0.5
+			return (joins, [(0, half), (1, half)])
+		return (joins, [])
+
+	#nodes get ids 0 .. 2N-2; slots of D are reused, and slot[id] is -1 once a node has been joined,
+	#so entries of old sorted rows that point at joined nodes are skipped
+	slot = np.empty(2 * N - 1, dtype=np.int64)
+	slot.fill(-1)
+	slot[:N] = np.arange(N)
+	nodeId = np.arange(N)
+	nextId = N
+	active = np.ones(N, dtype=bool)
+
+	S = np.empty((N, N))
+	S.fill(np.inf)
+	I = np.zeros((N, N), dtype=np.int64)
+	for i in range(N):
+		others = np.concatenate((np.arange(i), np.arange(i + 1, N)))
+		sortOrder = np.argsort(D[i, others], kind='mergesort')
+		S[i, :N-1] = D[i, others[sortOrder]]
+		I[i, :N-1] = others[sortOrder]
+	R = D.sum(axis=1)
+	r = N
+
+	while r > 3:
+		slots = np.flatnonzero(active)
+		maxR = R[slots].max()
+		qmin = np.inf
+		best = None
+
+		rows = slots
+		k = 0
+		while len(rows) and k < N - 1:
+			vals = S[rows, k:k+NJBLOCK]
+			cols = slot[I[rows, k:k+NJBLOCK]]
+			q = (r - 2) * vals - R[rows][:, None] - R[cols]
+			q[cols < 0] = np.inf
+			at = np.argmin(q)
+			if q.flat[at] < qmin:
+				qmin = q.flat[at]
+				best = (rows[at // q.shape[1]], cols.flat[at])
+
+			#rows whose next sorted distance already bounds Q above qmin have nothing better left
+			bound = (r - 2) * vals[:, -1] - R[rows] - maxR
+			rows = rows[bound < qmin]
+			k += NJBLOCK
+
+		i, j = min(best), max(best)
+		dij = float(D[i, j])
+		vi = 0.5 * dij + float(R[i] - R[j]) / (2.0 * (r - 2))
+		vj = dij - vi
+		joins.append((int(nodeId[i]), vi, int(nodeId[j]), vj))
+
+		#the joined node takes slot i; slot j is retired
+		active[j] = False
+		slot[nodeId[i]] = -1
+		slot[nodeId[j]] = -1
+		others = np.flatnonzero(active)
+		others = others[others != i]
+		newDist = 0.5 * (D[i, others] + D[j, others] - dij)
+		R[others] += newDist - D[i, others] - D[j, others]
+		D[i, others] = newDist
+		D[others, i] = newDist
+		R[i] = newDist.sum()
+		R[j] = 0.0
+
+		nodeId[i] = nextId
+		slot[nextId] = i
+		nextId += 1
+
+		sortOrder = np.argsort(newDist, kind='mergesort')
+		S[i, :] = np.inf
+		S[i, :len(others)] = newDist[sortOrder]
+		I[i, :len(others)] = nodeId[others[sortOrder]]
+		r -= 1
+
+	#the last three nodes meet at one internal node
+	a, b, c = np.flatnonzero(active)
+	va = 0.5 * float(D[a, b] + D[a, c] - D[b, c])
+	vb = float(D[a, b]) - va
+	vc = float(D[a, c]) - va
+	return (joins, [(int(nodeId[a]), va), (int(nodeId[b]), vb), (int(nodeId[c]), vc)])
+
+#merge distance of every row of a linkage, recovered from the heights (Hnew = (Ha + Hb + current) / 2)
+def mergeDistances(linkage):
+	N = len(linkage) + 1
+	heights = [0.0] * N + [float(merge[2]) for merge in linkage]
+	return [2 * float(merge[2]) - heights[int(merge[0])] - heights[int(merge[1])] for merge in linkage]
+
+#save a tree for later insertions: its linkage, the merge distance (cluster average distance) of every node, and the names
+def saveTree(fileName, linkage, Name):
+	linkage = np.array(linkage, dtype=np.float64).reshape(-1, 4)
+	np.savez(fileName, linkage=linkage, delta=np.array(mergeDistances(linkage)), names=np.array(Name))
+
+def loadTree(fileName):
+	saved = np.load(fileName)
+	linkage = saved["linkage"].tolist()
+	N = len(linkage) + 1
+	tree = {}
+	tree["left"] = [None] * N + [int(merge[0]) for merge in linkage]
+	tree["right"] = [None] * N + [int(merge[1]) for merge in linkage]
+	tree["height"] = [0.0] * N + [merge[2] for merge in linkage]
+	tree["delta"] = [0.0] * N + saved["delta"].tolist()
+	tree["parent"] = [None] * (2 * N - 1)
+	for node in range(N, 2 * N - 1):
+		tree["parent"][tree["left"][node]] = node
+		tree["parent"][tree["right"][node]] = node
+	tree["leaves"] = range(N)
+	tree["names"] = [str(name) for name in saved["names"].tolist()]
+	tree["root"] = 2 * N - 2
+	return tree
+
+#nodes below root with every node after all of its descendants
+def postorder(tree, root):
+	order = []
+	stack = [root]
+	while stack:
+		node = stack.pop()
+		order.append(node)
+		if tree["left"][node] is not None:
+			stack.append(tree["left"][node])
+			stack.append(tree["right"][node])
+	order.reverse()
+	return order
+
+def insertTaxon(tree, name, row):
+	left, right, delta, height, parent = tree["left"], tree["right"], tree["delta"], tree["height"], tree["parent"]
+	order = postorder(tree, tree["root"])
+
+	#WPGMA distance from the new taxon to every cluster: its row for the leaves, the mean of the two children above
+	dx = [None] * len(left)
+	for leaf, dist in zip(tree["leaves"], row):
+		dx[leaf] = dist
+	for node in order:
+		if left[node] is not None:
+			dx[node] = (dx[left[node]] + dx[right[node]]) * 0.5
+
+	#the taxon joins the cluster WPGMA would have met it at: the lowest max(delta, distance) that still comes
+	#before that cluster's own parent merge
+	attach = None
+	for node in order:
+		tau = max(delta[node], dx[node])
+		if parent[node] is None or tau < delta[parent[node]]:
+			if attach is None or tau < attachTau:
+				attach, attachTau = node, tau
+
+	#the new pair becomes a node in the attachment point's place
+	x, y = len(left), len(left) + 1
+	left.extend([None, attach])
+	right.extend([None, x])
+	parent.extend([y, parent[attach]])
+	delta.extend([0.0, attachTau])
+	height.extend([0.0, (height[attach] + attachTau) * 0.5])
+	tree["leaves"].append(x)
+	tree["names"].append(name)
+	up = parent[attach]
+	parent[attach] = y
+	if up is None:
+		tree["root"] = y
+	elif left[up] == attach:
+		left[up] = y
+	else:
+		right[up] = y
+
+	#only the ancestors of the attachment point change, and the subtrees hanging off that path keep their saved
+	#merge order. A kept unit is taken to be as far from a path sibling as the whole cluster it sits in (exact for
+	#ultrametric data), so the sibling met at the k-th ancestor is delta away from the path below it and e away
+	#from the new taxon. The taxon's half of that average is halved again by each of the k-1 merges on the way up,
+	#and no merge goes below the one beneath it
+	node = y
+	k = 0
+	while up is not None:
+		k += 1
+		sibling = right[up] if left[up] == node else left[up]
+		e = max(delta[sibling], dx[sibling])
+		current = max(delta[node], delta[up] + math.ldexp(e - delta[up], -k))
+		delta[up] = current
+		height[up] = (height[left[up]] + height[right[up]] + current) * 0.5
+		node = up
+		up = parent[up]
+
+#linkage and names of a tree, with leaves numbered in insertion order and merges in order of distance
+def treeLinkage(tree):
+	left, right = tree["left"], tree["right"]
+	order = postorder(tree, tree["root"])
+	internal = [node for node in order if left[node] is not None]
+	position = dict((node, k) for k, node in enumerate(order))
+	internal.sort(key=lambda node: (tree["delta"][node], position[node]))
+
+	ids = dict((leaf, k) for k, leaf in enumerate(tree["leaves"]))
+	sizes = dict((leaf, 1) for leaf in tree["leaves"])
+	N = len(tree["leaves"])
+	linkage = []
+	for node in internal:
+		sizes[node] = sizes[left[node]] + sizes[right[node]]
+		ids[node] = N + len(linkage)
+		linkage.append([ids[left[node]], ids[right[node]], tree["height"][node], sizes[node]])
+	return linkage, tree["names"]
+
+#add the taxa of a distance file, one row each (name, distances to every taxon already in the tree), to a saved tree
+def insertTaxa(tree, fileName):
+	for line in open(fileName):
+		line = line.strip().split()
+		if not line:
+			continue
+		count = len(tree["leaves"])
+		if len(line) - 1 < count:
+			print "Each new taxon needs a distance to every taxon already in the tree!"
+			sys.exit()
+		insertTaxon(tree, line[0], [float(value) for value in line[1:count+1]])
+
+#leaf sets of every merge of a linkage, as frozensets of leaf ids
+def linkageClades(linkage):
+	N = len(linkage) + 1
+	members = [frozenset([leaf]) for leaf in range(N)]
+	for merge in linkage:
+		members.append(members[int(merge[0])] | members[int(merge[1])])
+	return set(members[N:])
+
+#random symmetric distance matrix; small integers give many ties, and are exact in float32
+def randomDistances(rng, N, integers):
+	D = [[0.0] * N for i in range(N)]
+	for i in range(N):
+		for j in range(i):
+			if integers:
+				D[i][j] = D[j][i] = float(rng.randint(1, 8))
+			else:
+				D[i][j] = D[j][i] = rng.random()
+	return D
+
+#random ultrametric matrix: clusters are merged in random order at increasing heights
+def randomUltrametric(rng, N):
+	clusters = [[i] for i in range(N)]
+	D = [[0.0] * N for i in range(N)]
+	height = 0.0
+	while len(clusters) > 1:
+		height += rng.random() + 0.01
+		a, b = rng.sample(range(len(clusters)), 2)
+		for i in clusters[a]:
+			for j in clusters[b]:
+				D[i][j] = D[j][i] = 2 * height
+		merged = clusters[a] + clusters[b]
+		clusters = [cluster for k, cluster in enumerate(clusters) if k != a and k != b] + [merged]
+	return D
+
+def testNumpyLinkage():
+	import random
+	rng = random.Random(1)
+	for trial in range(100):
+		N = rng.randint(1, 25)
+		D = randomDistances(rng, N, trial % 2 == 0)
+		Name = ["t%d" % i for i in range(N)]
+		expected = newickString(upgmaLinkage([row[:] for row in D], N), Name)
+		assert upgmaNumpy(D, N, Name) == expected, "upgmaNumpyLinkage() test failed"
+
+		#the condensed triangle, column by column
+		cond = np.array([D[i][j] for j in range(N) for i in range(j)], dtype=np.float32)
+		if trial % 2 == 0:
+			assert upgmaNumpy(cond, N, Name, condensed=True) == expected, "condensed upgmaNumpyLinkage() test failed"
+	print "upgmaNumpyLinkage() tests passed!"
+
+#plain O(N^3) neighbor joining, recomputing every row sum and the whole Q-matrix at each join
+def naiveJoins(D, N):
+	D = [row[:] for row in D]
+	nodes = range(N)
+	joins = []
+	while len(D) > 3:
+		r = len(D)
+		R = [sum(row) for row in D]
+		best = None
+		for i in range(r):
+			for j in range(i + 1, r):
+				q = (r - 2) * D[i][j] - R[i] - R[j]
+				if best is None or q < best[0]:
+					best = (q, i, j)
+		q, i, j = best
+		dij = D[i][j]
+		vi = 0.5 * dij + (R[i] - R[j]) / (2.0 * (r - 2))
+		joins.append((nodes[i], vi, nodes[j], dij - vi))
+		newDist = [0.5 * (D[i][k] + D[j][k] - dij) for k in range(r)]
+		for k in range(r):
+			D[i][k] = D[k][i] = newDist[k]
+		D[i][i] = 0.0
+		nodes[i] = N + len(joins) - 1
+		del D[j]
+		for row in D:
+			del row[j]
+		del nodes[j]
+	va = 0.5 * (D[0][1] + D[0][2] - D[1][2])
+	return joins, [(nodes[0], va), (nodes[1], D[0][1] - va), (nodes[2], D[0][2] - va)]
+
+#branch length of every split of an unrooted tree, keyed by the side without leaf 0
+def joinSplits(joins, root, N):
+	members = [frozenset([leaf]) for leaf in range(N)]
+	edges = []
+	for a, va, b, vb in joins:
+		members.append(members[a] | members[b])
+		edges.extend([(a, va), (b, vb)])
+	everything = frozenset(range(N))
+	splits = {}
+	for node, length in edges + list(root):
+		side = members[node]
+		if 0 in side:
+			side = everything - side
+		splits[side] = splits.get(side, 0.0) + length
+	return splits
+
+def testNeighborJoin():
+	import random
+	rng = random.Random(2)
+	for trial in range(100):
+		N = rng.randint(3, 25)
+		D = randomDistances(rng, N, False)
+		(joins, root) = neighborJoinTree(D, N)
+		got = joinSplits(joins, root, N)
+		expected = joinSplits(*naiveJoins(D, N) + (N,))
+		assert set(got) == set(expected), "neighborJoin() topology test failed"
+		for side in got:
+			assert abs(got[side] - expected[side]) < 1e-9, "neighborJoin() branch length test failed"
+	print "neighborJoin() tests passed!"
+
+def testInsertTaxa():
+	import random
+	import tempfile
+	import os
+	rng = random.Random(3)
+	(handle, fileName) = tempfile.mkstemp(suffix=".npz")
+	os.close(handle)
+	for trial in range(50):
+		N = rng.randint(3, 25)
+		inserted = rng.randint(1, min(4, N - 2))
+		D = randomUltrametric(rng, N)
+		kept = N - inserted
+		baseLinkage = upgmaNumpyLinkage([row[:kept] for row in D[:kept]], kept)
+		saveTree(fileName, baseLinkage, ["t%d" % i for i in range(kept)])
+		tree = loadTree(fileName)
+		for taxon in range(kept, N):
+			insertTaxon(tree, "t%d" % taxon, D[taxon][:taxon])
+		(linkage, Name) = treeLinkage(tree)
+
+		expected = upgmaNumpyLinkage(D, N)
+		assert linkageClades(linkage) == linkageClades(expected), "insertTaxon() topology test failed"
+		heights = sorted(merge[2] for merge in linkage)
+		expectedHeights = sorted(merge[2] for merge in expected)
+		for x in range(N - 1):
+			assert abs(heights[x] - expectedHeights[x]) < 1e-9, "insertTaxon() height test failed"
+	os.remove(fileName)
+	print "insertTaxon() tests passed!"
+
+#checks the NumPy, neighbor-joining and insertion engines against the reference algorithms
+def testAll():
+	testNumpyLinkage()
+	testNeighborJoin()
+	testInsertTaxa()
+
 def main():
 
+	if "--test" in sys.argv:
+		if np is None:
+			print "NumPy is required for --test!"
+			sys.exit()
+		testAll()
+		return
+
 	errorCheck()
-	fileName = sys.argv[1]	
+	fileName = [arg for arg in sys.argv[1:] if not arg.startswith("--")][0]
 
 	try:
 		infile = open(fileName)
@@ -146,13 +845,83 @@ def main():
 		print "This file does not exist!"
 		sys.exit()
 
-	#import matrix
-	(scoreMatrix, N, Name) = importDist(fileName)
+	#one-time conversion of a text distmat to the binary condensed format
+	for arg in sys.argv:
+		if arg.startswith("--convert="):
+			convertDist(fileName, arg.split("=", 1)[1])
+			return
 
-	#find final newick tree
-	newick = upgma(scoreMatrix,N,Name)
-	
-	print newick
+	linkageName = None
+	saveName = None
+	insertName = None
+	for arg in sys.argv:
+		if arg.startswith("--linkage="):
+			linkageName = arg.split("=", 1)[1]
+		if arg.startswith("--save="):
+			saveName = arg.split("=", 1)[1]
+		if arg.startswith("--insert="):
+			insertName = arg.split("=", 1)[1]
+	if np is None and (saveName is not None or insertName is not None):
+		print "NumPy is required for --save and --insert!"
+		sys.exit()
+	if (saveName is not None or insertName is not None) and "--nj" in sys.argv:
+		print "--save and --insert are only available for UPGMA trees!"
+		sys.exit()
+
+	#add new taxa to a saved tree instead of clustering from scratch
+	if insertName is not None:
+		tree = loadTree(insertName)
+		insertTaxa(tree, fileName)
+		(linkage, Name) = treeLinkage(tree)
+		if saveName is not None:
+			saveTree(saveName, linkage, Name)
+		if linkageName is not None:
+			np.save(linkageName, np.array(linkage, dtype=np.float64).reshape(-1, 4))
+		writeNewick(sys.stdout, linkage, Name)
+		sys.stdout.write("\n")
+		return
+	if linkageName is not None and "--nj" in sys.argv:
+		print "--linkage is only available for UPGMA trees!"
+		sys.exit()
+
+	#binary condensed input is clustered straight from the memory map
+	if isCondensed(fileName):
+		if np is None:
+			print "NumPy is required for condensed input!"
+			sys.exit()
+		(scoreMatrix, N, Name) = importCondensed(fileName)
+		if "--nj" in sys.argv:
+			(joins, root) = neighborJoinTree(expandCondensed(scoreMatrix, N), N)
+			writeJoins(sys.stdout, joins, root, Name)
+			sys.stdout.write("\n")
+			return
+		linkage = upgmaNumpyLinkage(scoreMatrix,N,condensed=True)
+	else:
+		#import matrix
+		(scoreMatrix, N, Name) = importDist(fileName)
+
+		#find final newick tree
+		if "--numpy" in sys.argv or "--nj" in sys.argv or linkageName is not None:
+			if np is None:
+				print "NumPy is required for --numpy, --nj and --linkage!"
+				sys.exit()
+		if "--nj" in sys.argv:
+			(joins, root) = neighborJoinTree(scoreMatrix, N)
+			writeJoins(sys.stdout, joins, root, Name)
+			sys.stdout.write("\n")
+			return
+		elif "--numpy" in sys.argv:
+			linkage = upgmaNumpyLinkage(scoreMatrix,N)
+		else:
+			linkage = upgmaLinkage(scoreMatrix,N)
+
+	#save the merges for downstream tools, then stream the tree out
+	if saveName is not None:
+		saveTree(saveName, linkage, Name)
+	if linkageName is not None:
+		np.save(linkageName, np.array(linkage, dtype=np.float64).reshape(-1, 4))
+	writeNewick(sys.stdout, linkage, Name)
+	sys.stdout.write("\n")
 		
 if __name__ == "__main__":
 	main()
\ No newline at end of file
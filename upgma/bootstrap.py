@@ -0,0 +1,142 @@
+#! /usr/bin/python
+import sys
+import multiprocessing
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+from UPGMA import upgmaNumpyLinkage, writeNewick, optionValue
+from pdistance import readAlignment, pairDistance
+
+'''
+Bootstrap support for the UPGMA tree of an alignment (Stockholm or aligned FASTA).
+Each replicate draws the alignment columns with replacement as a vector of column counts; the compared
+sites and identities of all pairs under those counts come from two weighted matrix products over one-hot
+encodings of the alignment, so no resampled alignment is ever built. Replicate trees are clustered across
+a process pool, and every clade is tallied by the XOR of random 64-bit keys of its leaves, O(N) per tree.
+
+Input: bootstrap.py [alignment file]
+Output: the UPGMA tree of the full alignment in Newick format, with the percentage of replicates that
+contain each clade as the label of its internal node.
+
+Options:
+--replicates=R	number of bootstrap replicates (default: 100)
+--seed=S	random seed for the column draws and the clade keys (default: 1)
+--jc		cluster Jukes-Cantor distances instead of p-distances
+--processes=N	worker processes (default: one per CPU)
+'''
+
+#(bases, valid, jukesCantor) for replicateClades, in place before bootstrap() starts its pool
+encodingTable = None
+
+#one-hot encoding of the alignment: bases is N x 4L (one block of L columns per base), valid is N x L
+def encodeAlignment(seqs):
+	N = len(seqs)
+	L = len(seqs[0]) if N else 0
+	lookup = np.empty(256, dtype=np.uint8)
+	lookup.fill(4)
+	for base, code in zip("ACGTU", [0, 1, 2, 3, 3]):
+		lookup[ord(base)] = code
+	codes = np.empty((N, L), dtype=np.uint8)
+	for i, seq in enumerate(seqs):
+		codes[i] = lookup[np.frombuffer(seq, dtype=np.uint8)]
+
+	#float32 sums of whole column counts stay exact as long as they are below 2^24
+	bases = np.zeros((N, 4 * L), dtype=np.float32)
+	for b in range(4):
+		bases[:, b*L:(b+1)*L] = codes == b
+	valid = (codes < 4).astype(np.float32)
+	return bases, valid
+
+#all-pairs distances with every column counted weights[c] times
+def weightedDistances(bases, valid, weights, jukesCantor=False):
+	sites = np.dot(valid * weights, valid.T)
+	identical = np.dot(bases * np.tile(weights, 4), bases.T)
+	dist = pairDistance(sites - identical, sites, jukesCantor)
+	np.fill_diagonal(dist, 0.0)
+	return dist
+
+#key of every node of a linkage: leaves have their random key, a merge the XOR of its children's keys
+def cladeKeys(linkage, leafKeys):
+	N = len(leafKeys)
+	keys = list(leafKeys) + [0] * (N - 1)
+	for k, merge in enumerate(linkage.tolist()):
+		keys[N + k] = keys[int(merge[0])] ^ keys[int(merge[1])]
+	return keys[N:]
+
+#clade keys of the tree of one bootstrap replicate
+def replicateClades(job):
+	seed, leafKeys = job
+	bases, valid, jukesCantor = encodingTable
+	N, L = valid.shape
+	weights = np.random.RandomState(seed).multinomial(L, [1.0 / L] * L).astype(np.float32)
+	dist = weightedDistances(bases, valid, weights, jukesCantor)
+	return cladeKeys(upgmaNumpyLinkage(dist, N), leafKeys)
+
+def bootstrap(seqs, replicates=100, seed=1, jukesCantor=False, processes=None):
+	global encodingTable
+	N = len(seqs)
+	bases, valid = encodeAlignment(seqs)
+	encodingTable = (bases, valid, jukesCantor)
+
+	reference = upgmaNumpyLinkage(weightedDistances(bases, valid, np.ones(valid.shape[1], dtype=np.float32), jukesCantor), N)
+	random = np.random.RandomState(seed)
+	leafKeys = [(int(high) << 32) | int(low) for high, low in random.randint(0, 2**32, size=(N, 2))]
+	seeds = random.randint(0, 2**31 - 1, size=replicates)
+
+	#each replicate adds one to the tally of every clade in its tree
+	tally = {}
+	pool = multiprocessing.Pool(processes)
+	for keys in pool.imap_unordered(replicateClades, [(int(s), leafKeys) for s in seeds]):
+		for key in keys:
+			tally[key] = tally.get(key, 0) + 1
+	pool.close()
+	pool.join()
+	encodingTable = None
+
+	support = [100.0 * tally.get(key, 0) / max(1, replicates) for key in cladeKeys(reference, leafKeys)]
+	return reference, support
+
+def main():
+	if np is None:
+		print "NumPy is required for bootstrap.py!"
+		sys.exit()
+
+	args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	if len(args) < 1:
+		print "No alignment file provided!"
+		sys.exit()
+	if len(args) > 1:
+		print "Too many arguments!"
+		sys.exit()
+	replicates = int(optionValue(sys.argv, "replicates", 100))
+	seed = int(optionValue(sys.argv, "seed", 1))
+	processes = optionValue(sys.argv, "processes")
+	if processes is not None:
+		processes = int(processes)
+
+	try:
+		infile = open(args[0])
+	except IOError:
+		print "This file does not exist!"
+		sys.exit()
+	infile.close()
+	try:
+		names, seqs = readAlignment(args[0])
+	except IOError as e:
+		print e
+		sys.exit()
+
+	linkage, support = bootstrap(seqs, replicates, seed, "--jc" in sys.argv, processes)
+
+	#the root is in every replicate, so only the clades below it are labelled
+	labels = ["%d" % round(value) for value in support]
+	if labels:
+		labels[-1] = None
+	writeNewick(sys.stdout, linkage, names, labels)
+	sys.stdout.write("\n")
+
+if __name__ == "__main__":
+	main()
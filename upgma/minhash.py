@@ -0,0 +1,184 @@
+#! /usr/bin/python
+import sys
+import multiprocessing
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+from UPGMA import writeDist, writeCondensed, readFasta, optionValue
+
+'''
+Builds bottom-k MinHash sketches of the canonical k-mers of every record in a FASTA file and writes the
+Mash distances between all of them, so large collections can be clustered by UPGMA.py without aligning.
+
+Input: minhash.py [FASTA file] [output distmat file]
+(the distmat goes to standard output if no output file is given)
+
+Options:
+--k=K		k-mer length, at most 32 (default: 21)
+--size=S	hashes kept per sketch (default: 1000)
+--processes=N	worker processes for sketching and for the distances (default: one per CPU)
+--jaccard	write 1 - Jaccard instead of the Mash distance
+--condensed	write UPGMA.py's binary condensed format instead of text (an output file is required)
+'''
+
+#largest uint64, reserved as the padding of sketches with fewer than S hashes
+PADDING = np.uint64(0xffffffffffffffff) if np is not None else None
+
+#(sketches, lengths) read by sketchRow, a module global so the pool started in distanceRows gets it for free
+sketchTable = None
+
+#murmur3 64-bit finalizer, applied to a whole array of k-mer codes at once
+def mixHash(values):
+	values = values ^ (values >> np.uint64(33))
+	values = values * np.uint64(0xff51afd7ed558ccd)
+	values = values ^ (values >> np.uint64(33))
+	values = values * np.uint64(0xc4ceb9fe1a85ec53)
+	values = values ^ (values >> np.uint64(33))
+	return values
+
+#2-bit codes of every canonical k-mer of seq; k-mers with anything but ACGT are skipped
+def canonicalKmers(seq, k):
+	lookup = np.empty(256, dtype=np.uint8)
+	lookup.fill(4)
+	for base, code in zip("ACGTacgt", [0, 1, 2, 3, 0, 1, 2, 3]):
+		lookup[ord(base)] = code
+	codes = lookup[np.frombuffer(seq, dtype=np.uint8)]
+	count = len(codes) - k + 1
+	if count <= 0:
+		return np.zeros(0, dtype=np.uint64)
+
+	#a window is valid if it holds no unknown base
+	unknown = np.concatenate(([0], np.cumsum(codes == 4)))
+	valid = unknown[k:] == unknown[:-k]
+	codes = np.minimum(codes, 3).astype(np.uint64)
+
+	forward = np.zeros(count, dtype=np.uint64)
+	reverse = np.zeros(count, dtype=np.uint64)
+	for t in range(k):
+		forward = (forward << np.uint64(2)) | codes[t:t+count]
+		reverse = reverse | ((np.uint64(3) - codes[t:t+count]) << np.uint64(2 * t))
+	return np.minimum(forward, reverse)[valid]
+
+#the S smallest distinct hashes of the canonical k-mers of one record
+def sketchSequence(job):
+	seq, k, size = job
+	hashes = mixHash(canonicalKmers(seq, k))
+	hashes = np.unique(hashes[hashes != PADDING])
+	sketch = np.empty(size, dtype=np.uint64)
+	sketch.fill(PADDING)
+	sketch[:min(size, len(hashes))] = hashes[:size]
+	return sketch
+
+#sketches compared against one sketch per vectorized step of sketchRow
+ROWBLOCK = 1024
+
+#Jaccard estimates of sketch i against sketches 0 .. i-1, read from the bottom S hashes of each union
+def sketchRow(i):
+	sketches, lengths = sketchTable
+	size = sketches.shape[1]
+	mine = sketches[i, :lengths[i]]
+	jaccard = np.zeros(i)
+	for start in range(0, i, ROWBLOCK):
+		stop = min(i, start + ROWBLOCK)
+		others = sketches[start:stop]
+		otherLengths = lengths[start:stop]
+
+		#position of each of the other sketches' hashes among mine, and whether it is one of mine
+		pos = np.searchsorted(mine, others)
+		if len(mine):
+			shared = mine[np.minimum(pos, len(mine) - 1)] == others
+		else:
+			shared = np.zeros(others.shape, dtype=bool)
+		shared &= np.arange(size) < otherLengths[:, None]
+
+		#rank of each hash in the union of the two sketches, so shared hashes beyond the bottom S are not counted
+		before = np.cumsum(shared, axis=1) - shared
+		rank = pos + np.arange(size) - before
+		common = (shared & (rank < size)).sum(axis=1)
+		union = np.minimum(size, lengths[i] + otherLengths - shared.sum(axis=1))
+		jaccard[start:stop] = np.where(union > 0, common / np.maximum(union, 1).astype(np.float64), 0.0)
+	return jaccard
+
+def mashDistance(jaccard, k, useJaccard=False):
+	if useJaccard:
+		return 1.0 - jaccard
+	with np.errstate(divide='ignore'):
+		distance = -np.log(2.0 * jaccard / (1.0 + jaccard)) / k
+	return np.minimum(distance, 1.0)
+
+def sketchAll(infile, k, size, processes=None):
+	pool = multiprocessing.Pool(processes)
+	names = []
+	sketches = []
+
+	#records stream through the pool in order; only the sketches are kept
+	def jobs():
+		for name, seq in readFasta(infile):
+			names.append("_".join(name[1:].split()))
+			yield (seq, k, size)
+	for sketch in pool.imap(sketchSequence, jobs(), 16):
+		sketches.append(sketch)
+	pool.close()
+	pool.join()
+	return names, np.array(sketches, dtype=np.uint64).reshape(len(sketches), size)
+
+#rows of the lower triangle of the distance matrix, computed across a pool of workers in order
+def distanceRows(sketches, k, useJaccard=False, processes=None):
+	global sketchTable
+	lengths = (sketches != PADDING).sum(axis=1)
+	sketchTable = (sketches, lengths)
+	pool = multiprocessing.Pool(processes)
+	for jaccard in pool.imap(sketchRow, range(len(sketches)), 8):
+		yield mashDistance(jaccard, k, useJaccard)
+	pool.close()
+	pool.join()
+	sketchTable = None
+
+def main():
+	if np is None:
+		print "NumPy is required for minhash.py!"
+		sys.exit()
+
+	args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	if len(args) < 1:
+		print "No FASTA file provided!"
+		sys.exit()
+	if len(args) > 2:
+		print "Too many arguments!"
+		sys.exit()
+
+	k = int(optionValue(sys.argv, "k", 21))
+	size = int(optionValue(sys.argv, "size", 1000))
+	processes = optionValue(sys.argv, "processes")
+	if processes is not None:
+		processes = int(processes)
+	if k < 1 or k > 32:
+		print "k must be between 1 and 32!"
+		sys.exit()
+
+	try:
+		infile = open(args[0])
+	except IOError:
+		print "This file does not exist!"
+		sys.exit()
+	names, sketches = sketchAll(infile, k, size, processes)
+	infile.close()
+
+	rows = distanceRows(sketches, k, "--jaccard" in sys.argv, processes)
+	if "--condensed" in sys.argv:
+		if len(args) < 2:
+			print "--condensed needs an output file!"
+			sys.exit()
+		writeCondensed(args[1], names, rows)
+	elif len(args) == 2:
+		outfile = open(args[1], 'w')
+		writeDist(outfile, names, rows)
+		outfile.close()
+	else:
+		writeDist(sys.stdout, names, rows)
+
+if __name__ == "__main__":
+	main()
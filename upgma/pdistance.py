@@ -0,0 +1,178 @@
+#! /usr/bin/python
+import sys
+import multiprocessing
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+from UPGMA import writeDist, writeCondensed, readFasta, optionValue
+
+'''
+Builds the pairwise distance matrix of an alignment (Stockholm or aligned FASTA) for UPGMA.py.
+Every sequence is packed into bitplanes over the alignment columns (two bits of base code and one bit
+for "has a base"), so the compared sites and the mismatches of a pair are popcounts of ANDs and XORs
+of uint64 words. Columns where either sequence has a gap or an unknown base are left out of that pair.
+
+Input: pdistance.py [alignment file] [output distmat file]
+(the distmat goes to standard output if no output file is given)
+
+Options:
+--jc		write Jukes-Cantor distances instead of p-distances; saturated pairs (p >= 0.75) get 10.0
+--condensed	write UPGMA.py's binary condensed format instead of text (an output file is required)
+--processes=N	worker processes (default: one per CPU)
+--block=B	sequences per block of the all-pairs comparison (default: 64)
+'''
+
+#distance given to pairs with no comparable site, or too many differences for the Jukes-Cantor correction
+MAXDIST = 10.0
+
+#set bits of every byte value
+POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8) if np is not None else None
+
+#bitplanes of the alignment for distanceBlock; set by distanceRows so the forked workers inherit them
+planeTable = None
+
+#names and rows of a Stockholm alignment (blocks may be interleaved) or of an aligned FASTA file
+def readAlignment(fileName):
+	infile = open(fileName)
+	first = infile.readline()
+	infile.seek(0)
+	names = []
+	seqs = []
+	if first.startswith(">"):
+		#records are kept in file order, so repeated headers stay separate rows
+		for name, seq in readFasta(infile):
+			names.append("_".join(name[1:].split()))
+			seqs.append(seq.upper())
+	else:
+		#the blocks of an interleaved Stockholm file are joined by name
+		rows = {}
+		for line in infile:
+			if line.startswith("//"):
+				break
+			line = line.strip()
+			if not line or line.startswith("#"):
+				continue
+			name, seq = line.split()[:2]
+			if name not in rows:
+				names.append(name)
+				rows[name] = []
+			rows[name].append(seq)
+		seqs = [''.join(rows[name]).upper() for name in names]
+	infile.close()
+	if len(set(len(seq) for seq in seqs)) > 1:
+		raise IOError("Sequences in the alignment have different lengths!")
+	return names, seqs
+
+#pack every sequence into three bitplanes of uint64 words: the high and low bit of its base code, and whether
+#the column holds a base at all (gaps and unknown characters don't)
+def packAlignment(seqs):
+	lookup = np.empty(256, dtype=np.uint8)
+	lookup.fill(4)
+	for base, code in zip("ACGTU", [0, 1, 2, 3, 3]):
+		lookup[ord(base)] = code
+	N = len(seqs)
+	L = len(seqs[0]) if N else 0
+	words = (L + 63) // 64
+	codes = np.empty((N, words * 64), dtype=np.uint8)
+	codes.fill(4)
+	for i, seq in enumerate(seqs):
+		codes[i, :L] = lookup[np.frombuffer(seq, dtype=np.uint8)]
+
+	def plane(bits):
+		#np.packbits fills bytes most significant bit first; viewing 8 of them as a uint64 just
+		#permutes the columns inside a word, which popcounts don't care about
+		return np.packbits(bits, axis=1).view(np.uint64)
+	valid = codes < 4
+	high = plane(valid & (codes >= 2))
+	low = plane(valid & ((codes & 1) == 1))
+	return high, low, plane(valid)
+
+def popcount(words):
+	return POPCOUNT[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+def pairDistance(mismatches, sites, jukesCantor=False):
+	p = mismatches / np.maximum(sites, 1).astype(np.float64)
+	if jukesCantor:
+		saturated = p >= 0.75
+		with np.errstate(divide='ignore', invalid='ignore'):
+			dist = -0.75 * np.log(1.0 - p / 0.75)
+		dist[saturated] = MAXDIST
+	else:
+		dist = p
+	dist[sites == 0] = MAXDIST
+	return dist
+
+#rows start .. stop-1 of the lower triangle: each row against every earlier sequence, a block of columns at a time
+def distanceBlock(job):
+	start, stop, block, jukesCantor = job
+	high, low, valid = planeTable
+	sites = np.zeros((stop - start, stop), dtype=np.int64)
+	mismatches = np.zeros((stop - start, stop), dtype=np.int64)
+	for first in range(0, stop, block):
+		last = min(stop, first + block)
+		both = valid[start:stop, None, :] & valid[None, first:last, :]
+		differ = (high[start:stop, None, :] ^ high[None, first:last, :]) | (low[start:stop, None, :] ^ low[None, first:last, :])
+		sites[:, first:last] = popcount(both)
+		mismatches[:, first:last] = popcount(differ & both)
+	dist = pairDistance(mismatches, sites, jukesCantor)
+	return [dist[i - start, :i] for i in range(start, stop)]
+
+def distanceRows(seqs, jukesCantor=False, processes=None, block=64):
+	global planeTable
+	planeTable = packAlignment(seqs)
+	pool = multiprocessing.Pool(processes)
+	jobs = [(start, min(len(seqs), start + block), block, jukesCantor) for start in range(0, len(seqs), block)]
+	for rows in pool.imap(distanceBlock, jobs):
+		for row in rows:
+			yield row
+	pool.close()
+	pool.join()
+	planeTable = None
+
+def main():
+	if np is None:
+		print "NumPy is required for pdistance.py!"
+		sys.exit()
+
+	args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+	if len(args) < 1:
+		print "No alignment file provided!"
+		sys.exit()
+	if len(args) > 2:
+		print "Too many arguments!"
+		sys.exit()
+	processes = optionValue(sys.argv, "processes")
+	if processes is not None:
+		processes = int(processes)
+	block = int(optionValue(sys.argv, "block", 64))
+
+	try:
+		infile = open(args[0])
+	except IOError:
+		print "This file does not exist!"
+		sys.exit()
+	infile.close()
+	try:
+		names, seqs = readAlignment(args[0])
+	except IOError as e:
+		print e
+		sys.exit()
+
+	rows = distanceRows(seqs, "--jc" in sys.argv, processes, block)
+	if "--condensed" in sys.argv:
+		if len(args) < 2:
+			print "--condensed needs an output file!"
+			sys.exit()
+		writeCondensed(args[1], names, rows)
+	elif len(args) == 2:
+		outfile = open(args[1], 'w')
+		writeDist(outfile, names, rows)
+		outfile.close()
+	else:
+		writeDist(sys.stdout, names, rows)
+
+if __name__ == "__main__":
+	main()